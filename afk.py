@@ -1,19 +1,149 @@
 import asyncio
+import time
+from collections import OrderedDict
 from datetime import datetime
-import humanize
 from pyrogram import Client, filters
+from pyrogram.errors import FloodWait
 from pyrogram.types import Message
 from utils.misc import modules_help, prefix
 from utils.scripts import ReplyCheck
-from utils.db import db
+from .settings_cache import get_settings
+from .delete_scheduler import schedule_delete
 
 # Variables
 AFK = False
 AFK_REASON = ""
 DEFAULT_AFK_REASON = "Negotiating with aliens"
 AFK_TIME = ""
-USERS = {}
-GROUPS = {}
+
+# Throttling: each chat earns one reply every REPLY_INTERVAL seconds, up to MAX_REPLIES replies
+DEFAULT_REPLY_INTERVAL = 60
+DEFAULT_MAX_REPLIES = 10
+MAX_TRACKED_CHATS = 1000
+SAVE_DELAY = 5
+
+settings = get_settings("core.afk")
+
+
+class AfkThrottle:
+    """
+    Per-chat token bucket for AFK replies, bounded to the most recently active chats.
+    Message and chat totals are kept separately so evicting a chat doesn't change the summary.
+    """
+
+    def __init__(self, max_chats: int = MAX_TRACKED_CHATS):
+        self.max_chats = max_chats
+        self.chats = OrderedDict()  # chat_id -> [tokens, last_refill, replies]
+        self.messages = 0
+        self.chat_count = 0
+
+    def hit(self, chat_id: int, interval: float, max_replies: int, can_reply: bool = True):
+        """
+        Count an incoming message and decide whether to answer it.
+        :return: Number of replies sent to this chat including this one, or 0 if it shouldn't be answered.
+        """
+        now = time.time()
+        self.messages += 1
+        state = self.chats.pop(chat_id, None)
+        if state is None:
+            self.chat_count += 1
+            state = [1.0, now, 0]
+        tokens, last_refill, replies = state
+        tokens = min(1.0, tokens + (now - last_refill) / interval)
+        reply_number = 0
+        if can_reply and tokens >= 1 and replies < max_replies:
+            tokens -= 1
+            replies += 1
+            reply_number = replies
+        self.chats[chat_id] = [tokens, now, replies]
+        while len(self.chats) > self.max_chats:
+            self.chats.popitem(last=False)
+        return reply_number
+
+    def to_dict(self) -> dict:
+        return {
+            "messages": self.messages,
+            "chat_count": self.chat_count,
+            "chats": [[chat_id, *state] for chat_id, state in self.chats.items()],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        throttle = cls()
+        throttle.messages = data.get("messages", 0)
+        throttle.chat_count = data.get("chat_count", 0)
+        throttle.chats = OrderedDict((chat_id, state) for chat_id, *state in data.get("chats", []))
+        return throttle
+
+
+THROTTLE = AfkThrottle()
+_flood_until = 0.0
+_save_task = None
+
+
+def save_state():
+    """Persist AFK mode and throttling state so a restart doesn't end AFK."""
+    if not AFK:
+        if settings.get("afk_state") is not None:
+            settings.remove("afk_state")
+        return
+    settings.set(
+        "afk_state",
+        {"reason": AFK_REASON, "since": AFK_TIME.timestamp(), "throttle": THROTTLE.to_dict()},
+    )
+
+
+def restore_state():
+    global AFK, AFK_REASON, AFK_TIME, THROTTLE
+    state = settings.get("afk_state")
+    if state:
+        AFK = True
+        AFK_REASON = state["reason"]
+        AFK_TIME = datetime.fromtimestamp(state["since"])
+        THROTTLE = AfkThrottle.from_dict(state.get("throttle", {}))
+
+
+def schedule_save():
+    """Coalesce state writes during a message storm into one write every SAVE_DELAY seconds."""
+    global _save_task
+
+    async def delayed_save():
+        await asyncio.sleep(SAVE_DELAY)
+        save_state()
+
+    if _save_task is None or _save_task.done():
+        _save_task = asyncio.create_task(delayed_save())
+
+
+def reset_afk():
+    global AFK, AFK_TIME, AFK_REASON, THROTTLE
+    AFK = False
+    AFK_TIME = ""
+    AFK_REASON = ""
+    THROTTLE = AfkThrottle()
+    save_state()
+
+
+def afk_summary() -> str:
+    last_seen = subtract_time(datetime.now(), AFK_TIME).replace("ago", "").strip()
+    return (
+        f"<blockquote>\n"
+        f"While you were away (for {last_seen}), you received "
+        f"{THROTTLE.messages} messages "
+        f"from {THROTTLE.chat_count} chats.\n"
+        f"</blockquote>"
+    )
+
+
+async def send_afk_reply(bot: Client, chat_id: int, text: str):
+    """Send an AFK reply; on FloodWait stop replying everywhere until the wait is over."""
+    global _flood_until
+    try:
+        afk_message = await bot.send_message(chat_id=chat_id, text=text)
+    except FloodWait as e:
+        _flood_until = time.time() + e.value
+        return
+    schedule_delete(bot, afk_message.chat.id, afk_message.id, 30)
 
 
 def GetChatID(message: Message):
@@ -21,12 +151,24 @@ def GetChatID(message: Message):
     return message.chat.id
 
 
+def ordinal(number: int) -> str:
+    """Get humanized ordinal (1st, 2nd...)"""
+    import humanize
+
+    return humanize.ordinal(number)
+
+
 def subtract_time(start, end):
     """Get humanized time"""
+    import humanize
+
     subtracted = humanize.naturaltime(start - end)
     return str(subtracted)
 
 
+restore_state()
+
+
 @Client.on_message(
     ((filters.group & filters.mentioned) | filters.private)
     & ~filters.me
@@ -35,50 +177,31 @@ def subtract_time(start, end):
 )
 async def collect_afk_messages(bot: Client, message: Message):
     if AFK:
-        last_seen = subtract_time(datetime.now(), AFK_TIME)
-        is_group = message.chat.type in ["supergroup", "group"]
-        CHAT_TYPE = GROUPS if is_group else USERS
-
-        if GetChatID(message) not in CHAT_TYPE:
-            text = db.get("core.afk", "afk_msg", None)
-            if text is None:
-                text = (
-                    f"<blockquote>I'm unavailable (<i>since {last_seen}</i>).</blockquote>\n"
-                    f"<blockquote>"
-                    f"<b>Reason:</b> {AFK_REASON}.\n"
-                    f"Back soon. 👋\n"
-                    f"</blockquote>"
-                )
-            else:
-                last_seen = last_seen.replace("ago", "").strip()
-                text = f"<pre>\n{text.format(last_seen=last_seen, reason=AFK_REASON)}\n</pre>"
-
-            afk_message = await bot.send_message(
-                chat_id=GetChatID(message),
-                text=text,
-            )
-            CHAT_TYPE[GetChatID(message)] = 1
-            await asyncio.sleep(30)
-            await afk_message.delete()
+        max_replies = settings.get("max_replies", DEFAULT_MAX_REPLIES)
+        reply_number = THROTTLE.hit(
+            GetChatID(message),
+            interval=settings.get("reply_interval", DEFAULT_REPLY_INTERVAL),
+            max_replies=max_replies,
+            can_reply=time.time() >= _flood_until,
+        )
+        schedule_save()
+        if not reply_number:
             return
 
-        if CHAT_TYPE[GetChatID(message)] == 50:
+        last_seen = subtract_time(datetime.now(), AFK_TIME)
+        text = settings.get("afk_msg", None) if reply_number == 1 else None
+        if text is not None:
+            last_seen = last_seen.replace("ago", "").strip()
+            text = f"<pre>\n{text.format(last_seen=last_seen, reason=AFK_REASON)}\n</pre>"
+        elif reply_number == max_replies and max_replies > 1:
             text = (
                 f"<blockquote>I'm unavailable (<i>since {last_seen}</i>).</blockquote>\n"
                 f"<blockquote>"
-                f"This is the 10th time I've told you I'm AFK right now...\n"
+                f"This is the {ordinal(max_replies)} time I've told you I'm AFK right now...\n"
                 f"Back soon. 👋\n"
                 f"</blockquote>"
             )
-            afk_message = await bot.send_message(
-                chat_id=GetChatID(message),
-                text=text,
-            )
-            await asyncio.sleep(30)
-            await afk_message.delete()
-        elif CHAT_TYPE[GetChatID(message)] > 50:
-            return
-        elif CHAT_TYPE[GetChatID(message)] % 5 == 0:
+        else:
             text = (
                 f"<blockquote>I'm unavailable (<i>since {last_seen}</i>).</blockquote>\n"
                 f"<blockquote>"
@@ -86,14 +209,8 @@ async def collect_afk_messages(bot: Client, message: Message):
                 f"Back soon. 👋\n"
                 f"</blockquote>"
             )
-            afk_message = await bot.send_message(
-                chat_id=GetChatID(message),
-                text=text,
-            )
-            await asyncio.sleep(30)
-            await afk_message.delete()
 
-        CHAT_TYPE[GetChatID(message)] += 1
+        await send_afk_reply(bot, GetChatID(message), text)
 
 
 @Client.on_message(filters.command("afk", prefix) & filters.me, group=3)
@@ -108,29 +225,18 @@ async def afk_set(_, message: Message):
 
     AFK = True
     AFK_TIME = datetime.now()
+    save_state()
 
     await message.delete()
 
 
 @Client.on_message(filters.command("afk", "!") & filters.me, group=3)
-async def afk_unset(_, message: Message):
-    global AFK, AFK_TIME, AFK_REASON, USERS, GROUPS
-
+async def afk_unset(bot: Client, message: Message):
     if AFK:
-        last_seen = subtract_time(datetime.now(), AFK_TIME).replace("ago", "").strip()
-        await message.edit(
-            f"<blockquote>\n"
-            f"While you were away (for {last_seen}), you received "
-            f"{sum(USERS.values()) + sum(GROUPS.values())} messages "
-            f"from {len(USERS) + len(GROUPS)} chats.\n"
-            f"</blockquote>"
-        )
-        AFK = False
-        AFK_TIME = ""
-        AFK_REASON = ""
-        USERS = {}
-        GROUPS = {}
-        await asyncio.sleep(5)
+        await message.edit(afk_summary())
+        reset_afk()
+        schedule_delete(bot, message.chat.id, message.id, 5)
+        return
 
     await message.delete()
 
@@ -161,37 +267,43 @@ async def set_afk_msg(_, message: Message):
             "AFK message should contain <code>{last_seen}</code> to indicate where the last seen time will be placed."
         )
 
-    old_afk_msg = db.get("core.afk", "afk_msg", None)
+    old_afk_msg = settings.get("afk_msg", None)
     if old_afk_msg:
-        db.remove("core.afk", "afk_msg")
-    db.set("core.afk", "afk_msg", afk_msg)
+        settings.remove("afk_msg")
+    settings.set("afk_msg", afk_msg)
     await message.edit(f"AFK message set to:\n\n<pre>{afk_msg}</pre>")
 
 
-@Client.on_message(filters.me, group=3)
-async def auto_afk_unset(_, message: Message):
-    global AFK, AFK_TIME, AFK_REASON, USERS, GROUPS
+@Client.on_message(filters.command("afkthrottle", prefix) & filters.me, group=3)
+async def set_afk_throttle(_, message: Message):
+    args = message.command[1:]
+    if not args:
+        return await message.edit(
+            f"AFK replies: one every <code>{settings.get('reply_interval', DEFAULT_REPLY_INTERVAL)}</code>s "
+            f"per chat, at most <code>{settings.get('max_replies', DEFAULT_MAX_REPLIES)}</code> per chat."
+        )
+    if len(args) != 2 or not all(arg.isdigit() and int(arg) > 0 for arg in args):
+        return await message.edit(
+            f"<b>Usage:</b> <code>{prefix}afkthrottle [interval_seconds] [max_replies]</code>"
+        )
+    settings.set("reply_interval", int(args[0]))
+    settings.set("max_replies", int(args[1]))
+    await message.edit(
+        f"AFK replies set to one every <code>{args[0]}</code>s per chat, at most <code>{args[1]}</code> per chat."
+    )
 
+
+@Client.on_message(filters.me, group=3)
+async def auto_afk_unset(bot: Client, message: Message):
     if AFK:
-        last_seen = subtract_time(datetime.now(), AFK_TIME).replace("ago", "").strip()
-        reply = await message.reply(
-            f"<blockquote>\n"
-            f"While you were away (for {last_seen}), you received "
-            f"{sum(USERS.values()) + sum(GROUPS.values())} messages "
-            f"from {len(USERS) + len(GROUPS)} chats.\n"
-            f"</blockquote>"
-        )
-        AFK = False
-        AFK_TIME = ""
-        AFK_REASON = ""
-        USERS = {}
-        GROUPS = {}
-        await asyncio.sleep(5)
-        await reply.delete()
+        reply = await message.reply(afk_summary())
+        reset_afk()
+        schedule_delete(bot, reply.chat.id, reply.id, 5)
 
 
 modules_help["afk"] = {
     "afk [reason]": "Go to AFK mode with a reason.\nUsage: <code>.afk <reason></code>",
     "unafk": "Exit AFK mode.",
     "setafkmsg [reply to message]*": "Set your AFK message. Use <code>{reason}</code> and <code>{last_seen}</code> to indicate where placeholders will be replaced.",
+    "afkthrottle [interval_seconds] [max_replies]": "Show or set how often AFK replies are sent to the same chat.",
         }
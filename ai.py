@@ -1,20 +1,22 @@
-import os
-import time
-from PIL import Image
-import google.generativeai as genai
-from pyrogram import Client, filters, enums
+from pyrogram import Client, filters
 from utils.misc import modules_help, prefix
 from utils.scripts import format_exc
-from utils.config import gemini_key
-
-genai.configure(api_key=gemini_key)
-model = genai.GenerativeModel("gemini-1.5-flash-latest")
-model_cook = genai.GenerativeModel(
-    model_name="gemini-1.5-flash-latest",
-    generation_config={"temperature": 0.35, "top_p": 0.95, "top_k": 40, "max_output_tokens": 1024},
+from .ai_media import IMAGE_STATS, FileProcessingError, is_transcription_prompt, media_unique_id, pick_reduction, prepare_image
+from .ai_reply import StreamingReply
+from .ai_stats import timed
+from .ai_transcribe import is_long_audio, transcribe_long_audio
+from .gemini_client import (
+    cached_response,
+    file_cache,
+    parse_cache_flag,
+    response_cache,
+    response_cache_key,
+    stream_text,
+    upload_media,
 )
 
-async def process_file(message, prompt, model_to_use, file_type, status_msg, display_prompt=False):
+@timed("ai.total")
+async def process_file(message, prompt, model_to_use, file_type, status_msg, display_prompt=False, use_cache=True):
     """Processes files (image, audio, video) and interacts with Generative AI."""
     await message.edit_text(f"<code>{status_msg}</code>")
     reply = message.reply_to_message
@@ -22,73 +24,100 @@ async def process_file(message, prompt, model_to_use, file_type, status_msg, dis
     if not reply:
         return await message.edit_text(f"<b>Usage:</b> <code>{prefix}{message.command[0]} [custom prompt]</code> [Reply to a {file_type}]")
 
-    file_path = await reply.download()
-    if not file_path or not os.path.exists(file_path):
-        return await message.edit_text("<code>Failed to process the file. Try again.</code>")
+    result_text = f"**Prompt:** {prompt}\n" if display_prompt else ""
+    cache_key = response_cache_key(model_to_use, prompt, media_unique_id(reply)) if use_cache else None
+    cached = cached_response(cache_key)
+    if cached:
+        answer = StreamingReply(message, result_text + "**Answer:** ")
+        await answer.append(cached)
+        return await answer.finish()
 
     try:
         if file_type == "image" and reply.photo:
-            with Image.open(file_path) as img:
-                img.verify()
-                input_data = [prompt, img]
+            input_data = [prompt, await prepare_image(reply)]
 
-        elif file_type in ["audio", "video"] and (reply.audio or reply.voice or reply.video or reply.video_note):
-            uploaded_file = genai.upload_file(file_path)
-            while uploaded_file.state.name == "PROCESSING":
-                await message.edit_text("<code>In processing...</code>")
-                time.sleep(5)
-                uploaded_file = genai.get_file(uploaded_file.name)
+        elif file_type == "audio" and is_transcription_prompt(prompt) and is_long_audio(reply):
+            # Only transcripts can be stitched from segments; other prompts need the whole file
+            transcript = await transcribe_long_audio(message, reply, model_to_use, prompt)
+            if cache_key:
+                response_cache.set(cache_key, {"text": transcript})
+            answer = StreamingReply(message, result_text + "**Answer:** ")
+            await answer.append(transcript)
+            return await answer.finish()
 
-            if uploaded_file.state.name == "FAILED":
-                return await message.edit_text("<code>File processing failed. Please try again.</code>")
-            
+        elif file_type in ["audio", "video"] and (reply.audio or reply.voice or reply.video or reply.video_note):
+            uploaded_file = await upload_media(
+                reply,
+                file_type,
+                on_processing=lambda: message.edit_text("<code>In processing...</code>"),
+                reduction=pick_reduction(reply, prompt),
+            )
             input_data = [uploaded_file, prompt]
 
         else:
             return await message.edit_text(f"<code>Invalid {file_type} file. Please try again.</code>")
 
-        response = model_to_use.generate_content(input_data)
-
-        result_text = f"**Prompt:** {prompt}\n" if display_prompt else ""
-        result_text += f"**Answer:** {response.text}"
-        await message.edit_text(result_text, parse_mode=enums.ParseMode.MARKDOWN)
+        answer = StreamingReply(message, result_text + "**Answer:** ")
+        async for delta in stream_text(model_to_use, input_data, cache_key):
+            await answer.append(delta)
+        await answer.finish()
 
+    except FileProcessingError:
+        await message.edit_text("<code>File processing failed. Please try again.</code>")
     except Exception as e:
         await message.edit_text(f"<code>Error:</code> {format_exc(e)}")
-    finally:
-        if os.path.exists(file_path):
-            os.remove(file_path)
 
 @Client.on_message(filters.command("getai", prefix) & filters.me)
 async def getai(_, message):
     """Analyze an image using Generative AI."""
-    prompt = message.text.split(maxsplit=1)[1] if len(message.command) > 1 else "Get details of the image."
-    await process_file(message, prompt, model, "image", "Analyzing image...", display_prompt=len(message.command) > 1)
+    args, use_cache = parse_cache_flag(message)
+    prompt = args or "Get details of the image."
+    await process_file(message, prompt, "default", "image", "Analyzing image...", display_prompt=bool(args), use_cache=use_cache)
 
 @Client.on_message(filters.command("aicook", prefix) & filters.me)
 async def aicook(_, message):
     """Identify food in an image and generate cooking instructions."""
-    await process_file(message, "Identify the baked good in the image and provide an accurate recipe.", model_cook, "image", "Cooking...")
+    _, use_cache = parse_cache_flag(message)
+    await process_file(message, "Identify the baked good in the image and provide an accurate recipe.", "cook", "image", "Cooking...", use_cache=use_cache)
 
 @Client.on_message(filters.command("aiseller", prefix) & filters.me)
 async def aiseller(_, message):
     """Generate a marketing description for a product."""
-    if len(message.command) > 1:
-        target_audience = message.text.split(maxsplit=1)[1]
+    target_audience, use_cache = parse_cache_flag(message)
+    if target_audience:
         prompt = f"Generate a marketing description for the product.\nTarget Audience: {target_audience}"
-        await process_file(message, prompt, model, "image", "Generating description...", display_prompt=False)
+        await process_file(message, prompt, "default", "image", "Generating description...", display_prompt=False, use_cache=use_cache)
     else:
         await message.edit_text(f"<b>Usage:</b> <code>{prefix}aiseller [target audience]</code> [Reply to a product image]")
 
 @Client.on_message(filters.command(["transcribe", "trs"], prefix) & filters.me)
 async def transcribe(_, message):
     """Transcribe or summarize an audio or video file."""
-    prompt = message.text.split(maxsplit=1)[1] if len(message.command) > 1 else "Transcribe this file."
-    await process_file(message, prompt, model, "audio", "Transcribing...", display_prompt=len(message.command) > 1)
+    args, use_cache = parse_cache_flag(message)
+    prompt = args or "Transcribe this file."
+    await process_file(message, prompt, "default", "audio", "Transcribing...", display_prompt=bool(args), use_cache=use_cache)
+
+@Client.on_message(filters.command("aicache", prefix) & filters.me)
+async def aicache(_, message):
+    """Show or clear the Gemini upload and response caches."""
+    if len(message.command) > 1 and message.command[1] == "clear":
+        file_cache.clear()
+        response_cache.clear()
+        return await message.edit_text("<code>AI caches cleared.</code>")
+    await message.edit_text(
+        "<b>AI cache</b>\n"
+        f"<b>Responses:</b> <code>{len(response_cache)}</code> cached, "
+        f"<code>{response_cache.hits}</code> hits, <code>{response_cache.misses}</code> misses\n"
+        f"<b>Uploads:</b> <code>{len(file_cache)}</code> cached, "
+        f"<code>{file_cache.hits}</code> hits, <code>{file_cache.misses}</code> misses\n"
+        f"<b>Images:</b> <code>{IMAGE_STATS['images']}</code> sent, "
+        f"<code>{(IMAGE_STATS['original_bytes'] - IMAGE_STATS['sent_bytes']) // 1024}</code> KB saved"
+    )
 
 modules_help["generative"] = {
     "getai [custom prompt] [reply to image]*": "Analyze an image using AI.",
     "aicook [reply to image]*": "Identify food and generate cooking instructions.",
     "aiseller [target audience] [reply to image]*": "Generate marketing descriptions for products.",
     "transcribe [custom prompt] [reply to audio/video]*": "Transcribe or summarize an audio or video file.",
+    "aicache [clear]": "Show AI cache hit/miss counters or clear the caches. Add --nocache to any AI command to skip the cache.",
 }
@@ -0,0 +1,225 @@
+import os
+import time
+import asyncio
+import logging
+from io import BytesIO
+from contextlib import asynccontextmanager
+from .settings_cache import get_settings
+from .ai_stats import record_bytes, record_timing, stage
+
+# Media up to this size is downloaded into a BytesIO buffer instead of a temp file.
+IN_MEMORY_LIMIT = 20 * 1024 * 1024
+
+# Images are capped to MAX_IMAGE_EDGE on their long edge and re-encoded as JPEG before reaching Gemini.
+# The smallest Telegram photo size with a long edge of at least MIN_IMAGE_EDGE is downloaded.
+MAX_IMAGE_EDGE = 1536
+MIN_IMAGE_EDGE = 1024
+IMAGE_QUALITY = 85
+
+IMAGE_STATS = {"images": 0, "original_bytes": 0, "sent_bytes": 0}
+
+# FFmpeg reductions applied before upload. Gemini samples video at 1 fps, so nothing is lost there,
+# and speech only needs a mono low-bitrate Opus track.
+REDUCTIONS = {
+    "audio": (
+        ["-vn", "-ac", "1", "-ar", "16000", "-c:a", "libopus", "-b:a", "24k", "-application", "voip", "-f", "ogg"],
+        "audio/ogg",
+    ),
+    "video": (
+        [
+            "-vf", "fps=1,scale=-2:'min(480,ih)'",
+            "-c:v", "libx264", "-preset", "veryfast", "-crf", "32",
+            "-ac", "1", "-c:a", "aac", "-b:a", "32k",
+            "-movflags", "frag_keyframe+empty_moov", "-f", "mp4",
+        ],
+        "video/mp4",
+    ),
+}
+TRANSCRIPTION_WORDS = ("transcri", "subtitle", "lyrics", "caption")
+
+log = logging.getLogger(__name__)
+
+
+class FileProcessingError(ValueError):
+    """Raised when a file cannot be downloaded or Gemini fails to process it."""
+
+
+def get_media(reply):
+    """Return the media object (photo, video, document...) of a message, if any."""
+    return getattr(reply, reply.media.value, None) if reply.media else None
+
+
+def media_unique_id(reply):
+    """Return the Telegram file_unique_id of the media in a message, if any."""
+    return getattr(get_media(reply), "file_unique_id", None)
+
+
+def media_mime_type(reply):
+    """Best-effort MIME type of the media in a message."""
+    mime_type = getattr(get_media(reply), "mime_type", None)
+    if mime_type:
+        return mime_type
+    if reply.photo:
+        return "image/jpeg"
+    if reply.video_note:
+        return "video/mp4"
+    return "application/octet-stream"
+
+
+@asynccontextmanager
+async def downloaded_media(reply, file_type="file", in_memory=None):
+    """
+    Download the media of a message and clean it up afterwards.
+    Media below the configured in-memory limit never touches the filesystem.
+    :param reply: Message containing the media.
+    :param file_type: Human readable file kind used in error messages.
+    :param in_memory: Force (True) or forbid (False) the in-memory download; chosen by size if None.
+    :return: A BytesIO buffer for small media, otherwise a path to a temporary file.
+    """
+    if in_memory is None:
+        limit = get_settings("custom.gemini").get("in_memory_limit", IN_MEMORY_LIMIT)
+        file_size = getattr(get_media(reply), "file_size", None)
+        in_memory = file_size is not None and file_size <= limit
+
+    with stage("telegram.download"):
+        source = await reply.download(in_memory=in_memory)
+    record_bytes("telegram.download", source_size(source) if source else 0)
+    try:
+        if in_memory:
+            if not source or source.getbuffer().nbytes == 0:
+                raise FileProcessingError(f"Failed to download the {file_type}")
+        elif not source or not os.path.exists(source) or os.path.getsize(source) == 0:
+            raise FileProcessingError(f"Failed to download the {file_type}")
+        yield source
+    finally:
+        if source and not in_memory and os.path.exists(source):
+            os.remove(source)
+
+
+def source_size(source):
+    """Size in bytes of a downloaded file path or in-memory buffer."""
+    if hasattr(source, "getbuffer"):
+        return source.getbuffer().nbytes
+    return os.path.getsize(source) if os.path.exists(source) else 0
+
+
+def load_image(source):
+    """Verify an image and return a fully loaded copy that no longer needs the source."""
+    from PIL import Image
+
+    with Image.open(source) as img:
+        img.verify()
+    if hasattr(source, "seek"):
+        source.seek(0)
+    img = Image.open(source)
+    img.load()
+    return img
+
+
+def pick_photo_size(photo, min_edge):
+    """Return the smallest photo thumbnail whose long edge is at least min_edge, or None for the full photo."""
+    candidates = [thumb for thumb in photo.thumbs or [] if max(thumb.width, thumb.height) >= min_edge]
+    return min(candidates, key=lambda thumb: thumb.width * thumb.height) if candidates else None
+
+
+def encode_image(source, max_edge, quality):
+    """Downscale an image to max_edge on its long side and re-encode it as JPEG."""
+    from PIL import Image
+
+    img = load_image(source)
+    if max(img.size) > max_edge:
+        img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+    output = BytesIO()
+    img.save(output, format="JPEG", quality=quality, optimize=True)
+    return output.getvalue()
+
+
+async def prepare_image(reply):
+    """
+    Download a photo at the smallest adequate size and shrink it for Gemini.
+    :param reply: Message containing the photo.
+    :return: An inline JPEG part for generate_content.
+    """
+    settings = get_settings("custom.gemini")
+    max_edge = settings.get("max_image_edge", MAX_IMAGE_EDGE)
+    quality = settings.get("image_quality", IMAGE_QUALITY)
+    thumb = pick_photo_size(reply.photo, settings.get("min_image_edge", MIN_IMAGE_EDGE))
+
+    if thumb:
+        with stage("telegram.download"):
+            source = await reply._client.download_media(thumb.file_id, in_memory=True)
+        if not source or source.getbuffer().nbytes == 0:
+            raise FileProcessingError("Failed to download the image")
+        record_bytes("telegram.download", source.getbuffer().nbytes)
+        with stage("image.encode"):
+            data = await asyncio.to_thread(encode_image, source, max_edge, quality)
+    else:
+        async with downloaded_media(reply, "image") as source:
+            with stage("image.encode"):
+                data = await asyncio.to_thread(encode_image, source, max_edge, quality)
+
+    original_size = reply.photo.file_size or len(data)
+    IMAGE_STATS["images"] += 1
+    IMAGE_STATS["original_bytes"] += original_size
+    IMAGE_STATS["sent_bytes"] += len(data)
+    record_bytes("image.saved", original_size - len(data))
+    log.info("Image %s: %d -> %d bytes (%d saved)", reply.photo.file_unique_id, original_size, len(data), original_size - len(data))
+    return {"mime_type": "image/jpeg", "data": data}
+
+
+def is_transcription_prompt(prompt):
+    prompt = prompt.lower()
+    return any(word in prompt for word in TRANSCRIPTION_WORDS)
+
+
+def pick_reduction(reply, prompt):
+    """
+    Choose how to shrink media before upload: "audio" for speech-only prompts,
+    "video" for visual prompts on videos (unless disabled with reduce_video), else None.
+    """
+    if reply.voice:
+        # Voice notes already are mono Opus
+        return None
+    if (reply.audio or reply.video or reply.video_note) and is_transcription_prompt(prompt):
+        return "audio"
+    if (reply.video or reply.video_note) and get_settings("custom.gemini").get("reduce_video", True):
+        return "video"
+    return None
+
+
+async def reduce_media(file_path, reduction):
+    """
+    Run an FFmpeg reduction on a downloaded file without blocking the event loop.
+    :param file_path: Path of the original media.
+    :param reduction: Key of REDUCTIONS.
+    :return: (BytesIO with the reduced media, its MIME type), or None if FFmpeg is unavailable, failed or didn't help.
+    """
+    output_args, mime_type = REDUCTIONS[reduction]
+    started = time.perf_counter()
+    try:
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-hide_banner", "-loglevel", "error", "-i", file_path, *output_args, "pipe:1",
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+        )
+    except FileNotFoundError:
+        log.warning("ffmpeg not found, uploading %s without reduction", file_path)
+        return None
+    output, errors = await process.communicate()
+    record_timing(f"ffmpeg.{reduction}", time.perf_counter() - started)
+    if process.returncode != 0:
+        # E.g. a video without an audio track, or an FFmpeg build without libx264/libopus
+        log.warning("FFmpeg failed on %s (%s), uploading it without reduction: %s",
+                    file_path, reduction, errors.decode(errors="ignore").strip())
+        return None
+
+    original_size = os.path.getsize(file_path)
+    record_bytes(f"ffmpeg.{reduction}.saved", original_size - len(output))
+    log.info("Reduced %s (%s): %d -> %d bytes", file_path, reduction, original_size, len(output))
+    if not output or len(output) >= original_size:
+        return None
+    buffer = BytesIO(output)
+    buffer.name = "reduced.ogg" if reduction == "audio" else "reduced.mp4"
+    return buffer, mime_type
@@ -1,81 +1,155 @@
-import os
 import asyncio
-from pyrogram import Client, filters, enums
+from pyrogram import Client, filters
 from pyrogram.types import Message
-import google.generativeai as genai
-from PIL import Image
-from utils.config import gemini_key
 from utils.misc import prefix
 from utils.scripts import modules_help
+from .ai_media import media_unique_id, pick_reduction, prepare_image
+from .ai_reply import StreamingReply
+from .ai_stats import timed
+from .gemini_client import (
+    cached_response,
+    generate_text,
+    parse_cache_flag,
+    response_cache_key,
+    stream_text,
+    upload_media,
+)
 
-genai.configure(api_key=gemini_key)
-model = genai.GenerativeModel("gemini-1.5-flash")
+MODEL = "process"
 
-def split_message(text, max_length=4000):
-    return [text[i:i + max_length] for i in range(0, len(text), max_length)]
+# Batch mode: albums and "-n N" ranges are prepared concurrently
+BATCH_CONCURRENCY = 4
+MAX_BATCH = 10
 
-async def upload_file(file_path, file_type):
-    uploaded_file = genai.upload_file(file_path)
-    while uploaded_file.state.name == "PROCESSING":
-        await asyncio.sleep(10)
-        uploaded_file = genai.get_file(uploaded_file.name)
-    if uploaded_file.state.name == "FAILED":
-        raise ValueError(f"{file_type.capitalize()} failed to process")
-    return uploaded_file
+def is_pdf(document):
+    return document.mime_type == "application/pdf" or (document.file_name or "").lower().endswith(".pdf")
 
-async def prepare_file(reply, file_path, prompt):
+def is_supported(reply):
+    return bool(reply.photo or reply.video or reply.video_note or reply.audio or reply.voice or reply.document)
+
+async def prepare_part(reply, prompt):
     if reply.photo:
-        with Image.open(file_path) as img:
-            img.verify()
-            return [prompt, img]
+        return await prepare_image(reply)
     elif reply.video or reply.video_note:
-        return [prompt, await upload_file(file_path, "video")]
-    elif reply.document and file_path.endswith(".pdf"):
-        return [prompt, await upload_file(file_path, "PDF")]
+        return await upload_media(reply, "video", reduction=pick_reduction(reply, prompt))
+    elif reply.document and is_pdf(reply.document):
+        return await upload_media(reply, "PDF")
     elif reply.audio or reply.voice:
-        return [await upload_file(file_path, "audio"), prompt]
+        return await upload_media(reply, "audio", reduction=pick_reduction(reply, prompt))
     elif reply.document:
-        return [await upload_file(file_path, "document"), prompt]
+        return await upload_media(reply, "document")
     else:
         raise ValueError("Unsupported file type")
 
-async def process_file(message, prompt, is_custom_prompt):
+async def prepare_file(reply, prompt):
+    part = await prepare_part(reply, prompt)
+    if reply.audio or reply.voice or (reply.document and not is_pdf(reply.document)):
+        return [part, prompt]
+    return [prompt, part]
+
+def parse_batch_flags(args):
+    """Strip leading --each and -n N flags from the prompt."""
+    each, count = False, 1
+    words = args.split(" ")
+    while words:
+        if words[0] == "--each":
+            each = True
+            words = words[1:]
+        elif words[0] == "-n" and len(words) > 1 and words[1].isdigit():
+            count = min(int(words[1]), MAX_BATCH)
+            words = words[2:]
+        else:
+            break
+    return " ".join(words).strip(), each, count
+
+async def collect_batch(client, reply, count):
+    """Return the replied album, or `count` consecutive messages starting at the reply."""
+    if count > 1:
+        messages = await client.get_messages(reply.chat.id, list(range(reply.id, reply.id + count)))
+    elif reply.media_group_id:
+        messages = await client.get_media_group(reply.chat.id, reply.id)
+    else:
+        return [reply]
+    return [m for m in messages if m and not m.empty and is_supported(m)][:MAX_BATCH]
+
+async def process_batch(message, items, prompt, is_custom_prompt, each, use_cache):
+    header = (f"**Prompt:** {prompt}\n" if is_custom_prompt else "") + f"**Files:** {len(items)}\n"
+    answer = StreamingReply(message, header + ("" if each else "**Answer:** "))
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def prepare(item):
+        async with semaphore:
+            return await prepare_part(item, prompt)
+
+    if each:
+        # One request per item, run concurrently; answers are shown in album order
+        async def ask(item):
+            cache_key = response_cache_key(MODEL, prompt, media_unique_id(item)) if use_cache else None
+            cached = cached_response(cache_key)
+            if cached:
+                return cached
+            async with semaphore:
+                input_data = await prepare_file(item, prompt)
+            return await generate_text(MODEL, input_data, cache_key)
+
+        tasks = [asyncio.create_task(ask(item)) for item in items]
+        try:
+            for number, task in enumerate(tasks, start=1):
+                await answer.append(f"\n**{number}.** {await task or 'No content generated.'}\n")
+        finally:
+            for task in tasks:
+                task.cancel()
+    else:
+        media_key = ",".join(str(media_unique_id(item)) for item in items)
+        cache_key = response_cache_key(MODEL, prompt, media_key) if use_cache else None
+        cached = cached_response(cache_key)
+        if cached:
+            await answer.append(cached)
+        else:
+            parts = await asyncio.gather(*(prepare(item) for item in items))
+            async for delta in stream_text(MODEL, [*parts, prompt], cache_key):
+                await answer.append(delta)
+    await answer.finish(fallback=f"**Prompt:** {prompt}\n<code>No content generated.</code>")
+
+@timed("process.total")
+async def process_file(message, prompt, is_custom_prompt, use_cache=True, client=None, each=False, count=1):
     reply = message.reply_to_message
     if not reply:
         return await message.edit_text(f"<b>Usage:</b> <code>{prefix}{message.command[0]} [prompt]</code> [Reply to a file]")
-    file_path = await reply.download()
-    if not os.path.exists(file_path) or os.path.getsize(file_path) == 0:
-        return await message.edit_text("<code>Failed to process the file. Try again.</code>")
     try:
-        input_data = await prepare_file(reply, file_path, prompt)
-        response = model.generate_content(input_data)
-        result_text = (
-            (f"**Prompt:** {prompt}\n" if is_custom_prompt else "")
-            + f"**Answer:** {response.text}" if response and response.text
-            else f"**Prompt:** {prompt}\n<code>No content generated.</code>"
-        )
-        if len(result_text) > 4000:
-            for chunk in split_message(result_text):
-                await message.reply_text(chunk, parse_mode=enums.ParseMode.MARKDOWN)
-            await message.delete()
+        if client and (count > 1 or reply.media_group_id):
+            items = await collect_batch(client, reply, count)
+            if not items:
+                raise ValueError("Unsupported file type")
+            if len(items) > 1:
+                return await process_batch(message, items, prompt, is_custom_prompt, each, use_cache)
+            # The only supported message of the range may not be the replied one
+            reply = items[0]
+        cache_key = response_cache_key(MODEL, prompt, media_unique_id(reply)) if use_cache else None
+        answer = StreamingReply(message, (f"**Prompt:** {prompt}\n" if is_custom_prompt else "") + "**Answer:** ")
+        cached = cached_response(cache_key)
+        if cached:
+            await answer.append(cached)
         else:
-            await message.edit_text(result_text, parse_mode=enums.ParseMode.MARKDOWN)
+            input_data = await prepare_file(reply, prompt)
+            async for delta in stream_text(MODEL, input_data, cache_key):
+                await answer.append(delta)
+        await answer.finish(fallback=f"**Prompt:** {prompt}\n<code>No content generated.</code>")
     except ValueError as e:
         await message.edit_text(f"<code>{str(e)}</code>")
     except Exception as e:
         await message.edit_text(f"Error: {str(e)}")
-    finally:
-        if os.path.exists(file_path):
-            os.remove(file_path)
 
 @Client.on_message(filters.command(["process", "pr"], prefix) & filters.me)
-async def process_generic_file(_, message):
-    args = message.text.split(maxsplit=1)
-    is_custom_prompt = len(args) > 1
-    prompt = args[1] if is_custom_prompt else "Deeply analyze it, write complete details about it."
+async def process_generic_file(client, message):
+    args, use_cache = parse_cache_flag(message)
+    args, each, count = parse_batch_flags(args)
+    is_custom_prompt = bool(args)
+    prompt = args if is_custom_prompt else "Deeply analyze it, write complete details about it."
     await message.edit_text("<code>Processing file...</code>")
-    await process_file(message, prompt, is_custom_prompt)
+    await process_file(message, prompt, is_custom_prompt, use_cache, client=client, each=each, count=count)
 
 modules_help["aimage"] = {
-    "process [prompt] [reply to any file]*": "Process any file (image, audio, video, video note, PDF, or document).",
+    "process [prompt] [reply to any file]*": "Process any file (image, audio, video, video note, PDF, or document). Add --nocache to skip the response cache.",
+    "process [--each] [-n N] [prompt] [reply to album or file]*": "Process a whole album, or N messages starting at the reply, in one request. --each answers every file separately.",
     }
@@ -0,0 +1,89 @@
+import asyncio
+import time
+from pyrogram import enums
+from pyrogram.errors import FloodWait, MessageNotModified
+from .ai_stats import record_timing, stage
+
+MAX_LENGTH = 4000
+# Minimum seconds between two edits of the same message while streaming.
+EDIT_INTERVAL = 1.5
+
+
+def find_split(text, max_length=MAX_LENGTH):
+    """
+    Find where to cut text that exceeds max_length.
+    Prefers paragraph, then line, then word boundaries, and never cuts inside a code block.
+    """
+    window = text[:max_length]
+    for separator in ("\n\n", "\n", " "):
+        index = window.rfind(separator)
+        if index > max_length // 2:
+            split = index + len(separator)
+            break
+    else:
+        split = max_length
+    if window[:split].count("```") % 2:
+        fence = window.rfind("```", 0, split)
+        if fence > 0:
+            split = fence
+    return split
+
+
+class StreamingReply:
+    """
+    Shows a growing answer by editing a status message.
+    Edits are coalesced to at most one per EDIT_INTERVAL, FloodWait pauses editing
+    instead of failing, and text past MAX_LENGTH rolls over into a new reply.
+    """
+
+    def __init__(self, message, header=""):
+        self.message = message
+        self.text = header
+        self.received = False
+        self._shown = None
+        self._next_edit = 0.0
+        self._started = time.perf_counter()
+
+    async def append(self, delta):
+        if not self.received:
+            record_timing("reply.first_text", time.perf_counter() - self._started)
+        self.received = True
+        self.text += delta
+        while len(self.text) > MAX_LENGTH:
+            split = find_split(self.text)
+            head, self.text = self.text[:split].rstrip(), self.text[split:].lstrip()
+            await self._edit(head, force=True)
+            self.message = await self._send(self.text[:MAX_LENGTH] or "...")
+            self._shown = None
+        if time.monotonic() >= self._next_edit:
+            await self._edit(self.text + " ▌")
+
+    async def finish(self, fallback=None):
+        """Show the final text, or the fallback if nothing was appended."""
+        await self._edit(self.text if self.received or fallback is None else fallback, force=True)
+
+    async def _send(self, text):
+        while True:
+            try:
+                with stage("telegram.send"):
+                    return await self.message.reply_text(text, parse_mode=enums.ParseMode.MARKDOWN)
+            except FloodWait as e:
+                await asyncio.sleep(e.value)
+
+    async def _edit(self, text, force=False):
+        if text == self._shown:
+            return
+        while True:
+            try:
+                with stage("telegram.edit"):
+                    await self.message.edit_text(text, parse_mode=enums.ParseMode.MARKDOWN)
+                break
+            except MessageNotModified:
+                break
+            except FloodWait as e:
+                if not force:
+                    self._next_edit = time.monotonic() + e.value
+                    return
+                await asyncio.sleep(e.value)
+        self._shown = text
+        self._next_edit = time.monotonic() + EDIT_INTERVAL
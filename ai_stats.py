@@ -0,0 +1,161 @@
+import functools
+import json
+import time
+from collections import deque
+from contextlib import contextmanager
+from io import BytesIO
+from pyrogram import Client, filters
+from pyrogram.types import Message
+from utils.misc import modules_help, prefix
+from .settings_cache import reset_settings_stats, settings_stats
+
+# Only the most recent samples of every metric are kept.
+WINDOW = 500
+
+
+class RollingHistogram:
+    """Fixed-size window of samples with percentile summaries."""
+
+    def __init__(self, size=WINDOW):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def percentile(self, fraction):
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "max": max(self.samples, default=0),
+        }
+
+
+timings = {}
+sizes = {}
+tokens = {}
+
+
+def _histogram(metrics, name):
+    if name not in metrics:
+        metrics[name] = RollingHistogram()
+    return metrics[name]
+
+
+@contextmanager
+def stage(name):
+    """Time a pipeline stage (works around awaits as well)."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _histogram(timings, name).add(time.perf_counter() - started)
+
+
+def record_timing(name, seconds):
+    _histogram(timings, name).add(seconds)
+
+
+def timed(name):
+    """Decorator form of stage() for coroutine functions."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with stage(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_bytes(name, count):
+    if count:
+        _histogram(sizes, name).add(count)
+
+
+def record_usage(response, model_name=""):
+    """Record Gemini usage_metadata token counts of a (finished) response."""
+    usage = getattr(response, "usage_metadata", None)
+    if not usage:
+        return
+    prefix_name = f"{model_name}." if model_name else ""
+    _histogram(tokens, f"{prefix_name}prompt").add(usage.prompt_token_count or 0)
+    _histogram(tokens, f"{prefix_name}output").add(usage.candidates_token_count or 0)
+
+
+def export():
+    return {
+        "timings_seconds": {name: h.summary() for name, h in sorted(timings.items())},
+        "bytes": {name: h.summary() for name, h in sorted(sizes.items())},
+        "tokens": {name: h.summary() for name, h in sorted(tokens.items())},
+        "settings_cache": settings_stats(),
+    }
+
+
+def reset():
+    timings.clear()
+    sizes.clear()
+    tokens.clear()
+    reset_settings_stats()
+
+
+def _format_size(value):
+    for unit in ("B", "KB", "MB"):
+        if value < 1024:
+            return f"{value:.0f}{unit}"
+        value /= 1024
+    return f"{value:.1f}GB"
+
+
+@Client.on_message(filters.command("aistats", prefix) & filters.me)
+async def aistats(client: Client, message: Message):
+    """Show per-stage latency, transfer and token statistics."""
+    action = message.command[1].lower() if len(message.command) > 1 else ""
+    if action == "reset":
+        reset()
+        return await message.edit_text("<code>AI stats reset.</code>")
+    if action == "json":
+        document = BytesIO(json.dumps(export(), indent=2).encode())
+        document.name = "aistats.json"
+        await client.send_document(message.chat.id, document)
+        return await message.delete()
+
+    lines = ["<b>Latency</b> (count · p50 · p95 · max)"]
+    lines += [
+        f"<code>{name}</code>: {h.count} · {h.percentile(0.5):.2f}s · {h.percentile(0.95):.2f}s · {max(h.samples):.2f}s"
+        for name, h in sorted(timings.items())
+    ]
+    if sizes:
+        lines.append("\n<b>Bytes</b> (count · p50 · total)")
+        lines += [
+            f"<code>{name}</code>: {h.count} · {_format_size(h.percentile(0.5))} · {_format_size(h.total)}"
+            for name, h in sorted(sizes.items())
+        ]
+    if tokens:
+        lines.append("\n<b>Tokens</b> (requests · p50 · total)")
+        lines += [
+            f"<code>{name}</code>: {h.count} · {h.percentile(0.5):.0f} · {h.total:.0f}"
+            for name, h in sorted(tokens.items())
+        ]
+    cached = {module: counts for module, counts in sorted(settings_stats().items()) if counts["hits"] or counts["misses"]}
+    if cached:
+        lines.append("\n<b>Settings cache</b> (hits · misses)")
+        lines += [f"<code>{module}</code>: {counts['hits']} · {counts['misses']}" for module, counts in cached.items()]
+    if not timings:
+        lines.append("<i>No data yet.</i>")
+    await message.edit_text("\n".join(lines))
+
+
+modules_help["aistats"] = {
+    "aistats": "Show per-stage latency, bytes and Gemini token usage of the AI and ElevenLabs commands, and settings cache hits.",
+    "aistats json": "Export the statistics as a JSON file.",
+    "aistats reset": "Reset the statistics.",
+}
@@ -0,0 +1,209 @@
+import asyncio
+import difflib
+import logging
+import re
+import shutil
+from io import BytesIO
+from pyrogram.errors import FloodWait, MessageNotModified
+from .ai_media import REDUCTIONS, FileProcessingError, downloaded_media, get_media
+from .gemini_client import generate_text, upload_file
+
+# Recordings longer than LONG_AUDIO_SECONDS are transcribed as ~SEGMENT_SECONDS segments cut at silences.
+LONG_AUDIO_SECONDS = 15 * 60
+SEGMENT_SECONDS = 10 * 60
+SILENCE_SEARCH_SECONDS = 60
+OVERLAP_SECONDS = 5
+SEGMENT_CONCURRENCY = 4
+SEGMENT_RETRIES = 2
+PROGRESS_INTERVAL = 3
+
+TIMESTAMP = re.compile(r"\[(?:(\d+):)?(\d{1,2}):(\d{2})\]")
+STATUS_ICONS = {"pending": "⏳", "running": "🔄", "retrying": "🔁", "done": "✅", "failed": "❌"}
+
+log = logging.getLogger(__name__)
+
+
+def media_duration(reply):
+    return getattr(get_media(reply), "duration", None) or 0
+
+
+def is_long_audio(reply):
+    """Whether a recording should be transcribed in segments; without FFmpeg it is uploaded whole."""
+    return media_duration(reply) > LONG_AUDIO_SECONDS and shutil.which("ffmpeg") is not None
+
+
+def format_timestamp(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+async def run_ffmpeg(*args):
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-hide_banner", *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    output, errors = await process.communicate()
+    if process.returncode != 0:
+        raise FileProcessingError(f"FFmpeg failed: {errors.decode(errors='ignore').strip()[-300:]}")
+    return output, errors.decode(errors="ignore")
+
+
+async def detect_silences(file_path):
+    """Return the midpoints (in seconds) of silent stretches in a recording."""
+    _, log = await run_ffmpeg("-i", file_path, "-vn", "-af", "silencedetect=noise=-30dB:d=0.5", "-f", "null", "-")
+    starts = [float(value) for value in re.findall(r"silence_start: (-?[\d.]+)", log)]
+    ends = [float(value) for value in re.findall(r"silence_end: ([\d.]+)", log)]
+    return [(start + end) / 2 for start, end in zip(starts, ends)]
+
+
+def plan_segments(duration, silences):
+    """
+    Split [0, duration] into segments of about SEGMENT_SECONDS, cutting at the silence
+    closest to each target point. Every segment is widened by OVERLAP_SECONDS on both sides.
+    :return: List of (start, end) in seconds.
+    """
+    cuts = []
+    position = 0.0
+    while duration - position > SEGMENT_SECONDS * 1.5:
+        target = position + SEGMENT_SECONDS
+        nearby = [s for s in silences if abs(s - target) <= SILENCE_SEARCH_SECONDS]
+        cut = min(nearby, key=lambda s: abs(s - target)) if nearby else target
+        cuts.append(cut)
+        position = cut
+    bounds = [0.0, *cuts, float(duration)]
+    return [
+        (max(0.0, start - OVERLAP_SECONDS), min(float(duration), end + OVERLAP_SECONDS))
+        for start, end in zip(bounds, bounds[1:])
+    ]
+
+
+def shift_timestamps(text, offset):
+    """Turn segment-relative [mm:ss] timestamps into timestamps of the full recording."""
+    def shift(match):
+        hours, minutes, seconds = match.groups()
+        total = int(hours or 0) * 3600 + int(minutes) * 60 + int(seconds) + offset
+        return f"[{format_timestamp(total)}]"
+
+    return TIMESTAMP.sub(shift, text)
+
+
+def _words(text):
+    """Normalized words of a text with their end offsets, ignoring timestamps."""
+    words = []
+    for match in re.finditer(r"\S+", text):
+        if TIMESTAMP.fullmatch(match.group()):
+            continue
+        word = re.sub(r"\W", "", match.group().lower())
+        if word:
+            words.append((word, match.end()))
+    return words
+
+
+def stitch(previous, following, window=80, min_match=4):
+    """
+    Drop the part of `following` that repeats the end of `previous` because of the segment overlap.
+    :return: `following` without the duplicated lead-in.
+    """
+    tail = [word for word, _ in _words(previous)[-window:]]
+    head = _words(following)[:window]
+    matcher = difflib.SequenceMatcher(None, tail, [word for word, _ in head], autojunk=False)
+    match = matcher.find_longest_match(0, len(tail), 0, len(head))
+    if match.size < min_match:
+        return following
+    return following[head[match.b + match.size - 1][1]:].lstrip(" ,.;:-")
+
+
+class SegmentProgress:
+    """Keeps a per-segment status list in the status message, edited at most every PROGRESS_INTERVAL seconds."""
+
+    def __init__(self, message, segments):
+        self.message = message
+        self.segments = segments
+        self.states = ["pending"] * len(segments)
+        self._shown = None
+
+    def render(self):
+        lines = [
+            f"{STATUS_ICONS[state]} {index}. {format_timestamp(start)} - {format_timestamp(end)}"
+            for index, (state, (start, end)) in enumerate(zip(self.states, self.segments), start=1)
+        ]
+        done = self.states.count("done")
+        return f"<b>Transcribing {done}/{len(self.segments)} segments...</b>\n" + "\n".join(lines)
+
+    async def refresh(self):
+        text = self.render()
+        if text == self._shown:
+            return
+        try:
+            await self.message.edit_text(text)
+            self._shown = text
+        except (FloodWait, MessageNotModified):
+            pass
+        except Exception as e:
+            # Progress is cosmetic; a failed edit must not end the progress loop
+            log.warning("Could not update transcription progress: %s", e)
+
+    async def run(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(PROGRESS_INTERVAL)
+
+
+async def extract_segment(file_path, start, end):
+    output_args, mime_type = REDUCTIONS["audio"]
+    output, _ = await run_ffmpeg(
+        "-loglevel", "error", "-ss", f"{start:.2f}", "-t", f"{end - start:.2f}", "-i", file_path, *output_args, "pipe:1"
+    )
+    buffer = BytesIO(output)
+    buffer.name = "segment.ogg"
+    return buffer, mime_type
+
+
+async def transcribe_long_audio(message, reply, model, prompt):
+    """
+    Transcribe a long recording as concurrent overlapping segments and stitch them in order.
+    Failed segments are retried on their own and, if they keep failing, replaced by a note
+    instead of failing the whole transcript. Progress is shown in the status message.
+    :return: The stitched transcript with [h:mm:ss] timestamps.
+    """
+    async with downloaded_media(reply, "audio", in_memory=False) as file_path:
+        duration = media_duration(reply)
+        segments = plan_segments(duration, await detect_silences(file_path))
+        progress = SegmentProgress(message, segments)
+        semaphore = asyncio.Semaphore(SEGMENT_CONCURRENCY)
+
+        async def transcribe_segment(index, start, end):
+            segment_prompt = (
+                f"{prompt}\n"
+                f"This is part {index + 1} of {len(segments)} of a longer recording. "
+                "Start every paragraph with a [mm:ss] timestamp relative to the start of this part."
+            )
+            async with semaphore:
+                for attempt in range(SEGMENT_RETRIES + 1):
+                    progress.states[index] = "running" if attempt == 0 else "retrying"
+                    try:
+                        source, mime_type = await extract_segment(file_path, start, end)
+                        uploaded_file = await upload_file(source, "audio", mime_type=mime_type)
+                        text = await generate_text(model, [uploaded_file, segment_prompt])
+                        progress.states[index] = "done"
+                        return shift_timestamps(text, start)
+                    except Exception as e:
+                        if attempt == SEGMENT_RETRIES:
+                            progress.states[index] = "failed"
+                            return f"[{format_timestamp(start)}] _(part {index + 1} could not be transcribed: {e})_"
+                        await asyncio.sleep(2 ** attempt)
+
+        progress_task = asyncio.create_task(progress.run())
+        try:
+            texts = await asyncio.gather(
+                *(transcribe_segment(index, start, end) for index, (start, end) in enumerate(segments))
+            )
+        finally:
+            progress_task.cancel()
+            await progress.refresh()
+
+    transcript = texts[0].strip()
+    for text in texts[1:]:
+        transcript += "\n\n" + stitch(transcript, text.strip())
+    return transcript
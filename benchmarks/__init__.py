@@ -0,0 +1 @@
+"""Offline load tests of the plugin modules; see benchmarks/__main__.py."""
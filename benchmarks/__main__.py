@@ -0,0 +1,312 @@
+"""
+Offline load test of the AI, ElevenLabs and AFK handlers.
+
+    python -m benchmarks --scenario all --requests 200 --concurrency 20 --json bench.json
+
+Run it from the directory holding the plugin modules. Telegram, Gemini and the userbot's utils
+package are replaced by benchmarks.fakes and ElevenLabs by a local server, so no network access
+or credentials are needed. FFmpeg, Pillow, httpx and humanize must be installed as for the bot.
+Every scenario reports latency percentiles, event-loop stalls and memory use.
+"""
+import argparse
+import asyncio
+import importlib
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from datetime import datetime
+from io import BytesIO
+from . import fakes
+from .fakes import Latency
+from .tts_server import TTSServer, make_mp3
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PACKAGE = "plugins"
+SCENARIOS = ("ai", "process", "el", "afk")
+STALL_INTERVAL = 0.01
+STALL_THRESHOLD = 0.005
+
+
+def load_plugin(name: str):
+    """Import a plugin module as part of a package so its relative imports resolve."""
+    if PACKAGE not in sys.modules:
+        package = types.ModuleType(PACKAGE)
+        package.__path__ = [ROOT]
+        sys.modules[PACKAGE] = package
+    return importlib.import_module(f"{PACKAGE}.{name}")
+
+
+def percentile(ordered: list, fraction: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+class LoopMonitor:
+    """Measures how late a short periodic sleep wakes up, i.e. how long the event loop was blocked."""
+
+    def __init__(self, interval: float = STALL_INTERVAL, threshold: float = STALL_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls = []
+        self._task = None
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = time.perf_counter() - started - self.interval
+            if lag > self.threshold:
+                self.stalls.append(lag)
+
+    def __enter__(self):
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    def __exit__(self, *exc):
+        self._task.cancel()
+
+    def summary(self) -> dict:
+        return {
+            "stall_total": sum(self.stalls),
+            "stall_max": max(self.stalls, default=0.0),
+            "stalls_over_50ms": sum(lag > 0.05 for lag in self.stalls),
+        }
+
+
+async def run_load(request, count: int, concurrency: int) -> dict:
+    """
+    Run `count` requests with at most `concurrency` in flight and collect their statistics.
+    :param request: Coroutine function taking the request number and returning whether it succeeded.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    failures = 0
+
+    async def one(number):
+        nonlocal failures
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                ok = await request(number)
+            except Exception as e:
+                print(f"  request {number} raised {type(e).__name__}: {e}", file=sys.stderr)
+                ok = False
+            latencies.append(time.perf_counter() - started)
+            failures += not ok
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    with LoopMonitor() as monitor:
+        await asyncio.gather(*(one(number) for number in range(count)))
+    wall = time.perf_counter() - started
+    _, memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        "requests": count,
+        "concurrency": concurrency,
+        "failures": failures,
+        "wall": wall,
+        "throughput": count / wall if wall else 0.0,
+        "p50": percentile(latencies, 0.50),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "max": latencies[-1] if latencies else 0.0,
+        **monitor.summary(),
+        "python_peak_mb": memory_peak / 2 ** 20,
+        "rss_peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+class Bench:
+    """Builds the fake messages of each scenario and drives the real handlers with them."""
+
+    def __init__(self, args):
+        self.args = args
+        self.client = fakes.FakeClient()
+        self.payloads = {}
+        self.server = None
+
+    async def prepare(self):
+        from PIL import Image
+
+        def jpeg(width, height):
+            buffer = BytesIO()
+            Image.effect_noise((width, height), 64).convert("RGB").save(buffer, format="JPEG", quality=90)
+            return buffer.getvalue()
+
+        self.payloads["photo"] = await asyncio.to_thread(jpeg, 2560, 1920)
+        self.payloads["thumb"] = await asyncio.to_thread(jpeg, 1280, 960)
+        self.payloads["voice"] = os.urandom(64 * 1024)
+        if shutil.which("ffmpeg"):
+            self.payloads["audio"] = await make_mp3(self.args.audio_seconds)
+
+    def media_message(self, number: int, command: str):
+        """A command message replying to a fresh media message (new file ids, so no cache hits)."""
+        kind = self.args.media
+        chat_id = 1000 + number
+        if kind == "photo":
+            thumb = self.client.media(self.payloads["thumb"], width=1280, height=960)
+            media = self.client.media(self.payloads["photo"], "image/jpeg", thumbs=[thumb], width=2560, height=1920)
+        elif kind == "voice":
+            media = self.client.media(self.payloads["voice"], "audio/ogg", duration=20)
+        else:
+            media = self.client.media(self.payloads["audio"], "audio/mpeg", duration=self.args.audio_seconds)
+        reply = fakes.FakeMessage(self.client, chat_id, media=media, media_kind=kind)
+        self.client.messages[reply.id] = reply
+        return fakes.FakeMessage(self.client, chat_id, command, reply_to_message=reply)
+
+    async def scenario_ai(self):
+        ai = load_plugin("ai")
+        file_type = "image" if self.args.media == "photo" else "audio"
+
+        async def request(number):
+            message = self.media_message(number, f".getai Describe file {number}")
+            await ai.process_file(message, f"Describe file {number}", "default", file_type, "Processing...")
+            return "**Answer:**" in message.text
+
+        return await run_load(request, self.args.requests, self.args.concurrency)
+
+    async def scenario_process(self):
+        ai_process = load_plugin("ai_process")
+
+        async def request(number):
+            message = self.media_message(number, f".process Summarize file {number}")
+            await ai_process.process_file(message, f"Summarize file {number}", True, client=self.client)
+            return "**Answer:**" in message.text
+
+        return await run_load(request, self.args.requests, self.args.concurrency)
+
+    async def scenario_el(self):
+        el = load_plugin("el")
+        self.server = await TTSServer(
+            first_byte=Latency(self.args.tts_first_byte, self.args.tts_first_byte / 2),
+            error_rate=self.args.tts_error_rate,
+        ).start()
+        el.API_URL = self.server.url
+        el.settings.set("api_key", "bench")
+        el.tts_cache = el.TTSCache(tempfile.mkdtemp(prefix="bench-tts-"))
+        sentence = "The quick brown fox jumps over the lazy dog. "
+        text = (sentence * (self.args.text_chars // len(sentence) + 1))[:self.args.text_chars]
+        for chunk in [text, *el.split_text(text)]:
+            await self.server.audio_for(chunk)
+
+        async def request(number):
+            chat_id = 2000 + number
+            sent = self.client.wait_for_send(chat_id)
+            await el.elevenlabs_command(self.client, fakes.FakeMessage(self.client, chat_id, f".el {number} {text}"))
+            return hasattr(await sent, "voice_bytes")
+
+        try:
+            return await run_load(request, self.args.requests, self.args.concurrency)
+        finally:
+            if el._http_client is not None:
+                await el._http_client.aclose()
+            await self.server.stop()
+
+    async def scenario_afk(self):
+        afk = load_plugin("afk")
+        afk.AFK, afk.AFK_REASON, afk.AFK_TIME = True, "Benchmarking", datetime.now()
+        afk.THROTTLE = afk.AfkThrottle()
+        chats = max(1, self.args.chats or self.args.requests // 5)
+
+        async def request(number):
+            message = fakes.FakeMessage(self.client, 3000 + number % chats, f"Are you there? {number}")
+            await afk.collect_afk_messages(self.client, message)
+            return True
+
+        result = await run_load(request, self.args.requests, self.args.concurrency)
+        result["replies"] = sum(state[2] for state in afk.THROTTLE.chats.values())
+        afk.reset_afk()
+        return result
+
+
+def format_report(name: str, result: dict) -> str:
+    return (
+        f"{name:<8} n={result['requests']} c={result['concurrency']} failed={result['failures']} "
+        f"{result['throughput']:.1f} req/s | "
+        f"p50 {result['p50'] * 1000:.0f}ms p95 {result['p95'] * 1000:.0f}ms "
+        f"p99 {result['p99'] * 1000:.0f}ms max {result['max'] * 1000:.0f}ms | "
+        f"stalls {result['stall_total'] * 1000:.0f}ms total, {result['stall_max'] * 1000:.0f}ms max, "
+        f"{result['stalls_over_50ms']} over 50ms | "
+        f"heap peak {result['python_peak_mb']:.1f}MB, rss {result['rss_peak_mb']:.0f}MB"
+    )
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks", description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scenario", choices=(*SCENARIOS, "all"), default="all")
+    parser.add_argument("--requests", "-n", type=int, default=100)
+    parser.add_argument("--concurrency", "-c", type=int, default=10)
+    parser.add_argument("--media", choices=("photo", "audio", "voice"), default="photo",
+                        help="media replied to in the ai and process scenarios")
+    parser.add_argument("--audio-seconds", type=int, default=60)
+    parser.add_argument("--text-chars", type=int, default=600, help="length of the .el text")
+    parser.add_argument("--chats", type=int, default=0, help="distinct chats in the afk scenario")
+    latency = parser.add_argument_group("simulated latencies (seconds, jittered by +/- half)")
+    latency.add_argument("--telegram", type=float, default=0.05)
+    latency.add_argument("--download", type=float, default=0.2)
+    latency.add_argument("--upload", type=float, default=0.5)
+    latency.add_argument("--processing", type=float, default=2.0, help="time a Gemini file stays PROCESSING")
+    latency.add_argument("--first-token", type=float, default=0.6)
+    latency.add_argument("--token", type=float, default=0.05)
+    latency.add_argument("--tts-first-byte", type=float, default=0.4)
+    parser.add_argument("--chunks", type=int, default=20, help="streamed chunks per Gemini answer")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="share of Telegram edits raising FloodWait")
+    parser.add_argument("--tts-error-rate", type=float, default=0.0, help="share of TTS requests answered with 429")
+    parser.add_argument("--provider-limits", action="store_true",
+                        help="keep the default Gemini/ElevenLabs rate limits instead of lifting them")
+    parser.add_argument("--json", metavar="PATH", help="also write the results and per-stage .aistats data here")
+    return parser.parse_args(argv)
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+    os.environ["NO_PROXY"] = "127.0.0.1,localhost"
+    jittered = lambda value: Latency(value, value / 2)  # noqa: E731
+    fakes.install(
+        telegram=jittered(args.telegram),
+        download=jittered(args.download),
+        upload=jittered(args.upload),
+        processing=jittered(args.processing),
+        first_token=jittered(args.first_token),
+        token=jittered(args.token),
+        chunks=args.chunks,
+        flood_rate=args.flood_rate,
+    )
+    if not args.provider_limits:
+        for provider in ("gemini", "elevenlabs"):
+            fakes.db.set("custom.providers", provider, {"rpm": 0, "tpm": 0, "concurrency": 0})
+    ai_stats = load_plugin("ai_stats")
+    bench = Bench(args)
+    await bench.prepare()
+
+    scenarios = SCENARIOS if args.scenario == "all" else (args.scenario,)
+    needs_ffmpeg = {"el"} | ({"ai", "process"} if args.media == "audio" else set())
+    report = {}
+    for name in scenarios:
+        if name in needs_ffmpeg and not shutil.which("ffmpeg"):
+            print(f"{name:<8} skipped: ffmpeg not found")
+            continue
+        ai_stats.reset()
+        result = await getattr(bench, f"scenario_{name}")()
+        result["stages"] = ai_stats.export()
+        report[name] = result
+        print(format_report(name, result))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,416 @@
+"""
+In-process stand-ins for pyrogram, google.generativeai and the userbot's utils package.
+install() registers them in sys.modules so the plugin modules import unchanged.
+"""
+import asyncio
+import enum
+import itertools
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import types
+from io import BytesIO
+
+
+class Latency:
+    """A simulated delay of `mean` seconds, uniformly spread by +/- `jitter`."""
+
+    def __init__(self, mean: float = 0.0, jitter: float = 0.0):
+        self.mean = mean
+        self.jitter = jitter
+
+    def sample(self) -> float:
+        return max(0.0, self.mean + random.uniform(-self.jitter, self.jitter))
+
+    async def wait(self):
+        await asyncio.sleep(self.sample())
+
+    def block(self):
+        time.sleep(self.sample())
+
+
+class FakeConfig:
+    """Latencies of the fake Telegram and Gemini backends. Every field can be overridden by install()."""
+
+    def __init__(self, **overrides):
+        self.telegram = Latency(0.05, 0.02)
+        self.download = Latency(0.2, 0.1)
+        self.upload = Latency(0.5, 0.2)
+        self.processing = Latency(2.0, 1.0)
+        self.get_file = Latency(0.1, 0.05)
+        self.first_token = Latency(0.6, 0.3)
+        self.token = Latency(0.05, 0.02)
+        self.chunks = 20
+        self.flood_rate = 0.0
+        for name, value in overrides.items():
+            if not hasattr(self, name):
+                raise AttributeError(f"Unknown fake setting: {name}")
+            setattr(self, name, value)
+
+
+config = FakeConfig()
+
+
+# --- pyrogram ---------------------------------------------------------------------------
+
+class Filter:
+    """Composable no-op filter; handlers are called directly by the benchmark."""
+
+    def __and__(self, other):
+        return Filter()
+
+    __or__ = __rand__ = __ror__ = __and__
+
+    def __invert__(self):
+        return Filter()
+
+
+class ParseMode(enum.Enum):
+    DEFAULT = "default"
+    MARKDOWN = "markdown"
+    HTML = "html"
+    DISABLED = "disabled"
+
+
+class MessageMediaType(enum.Enum):
+    PHOTO = "photo"
+    AUDIO = "audio"
+    VOICE = "voice"
+    VIDEO = "video"
+    VIDEO_NOTE = "video_note"
+    DOCUMENT = "document"
+
+
+class FloodWait(Exception):
+    def __init__(self, value: int = 0):
+        super().__init__(f"A wait of {value} seconds is required")
+        self.value = value
+
+
+class MessageNotModified(Exception):
+    pass
+
+
+class ContinuePropagation(StopAsyncIteration):
+    pass
+
+
+_message_ids = itertools.count(1)
+_file_ids = itertools.count(1)
+
+
+class FakeMessage:
+    """Message with the attributes and coroutine methods the plugins use. Every edit is recorded."""
+
+    def __init__(self, client, chat_id: int, text: str = "", reply_to_message=None, media=None, media_kind=None):
+        self._client = client
+        self.id = next(_message_ids)
+        self.chat = types.SimpleNamespace(id=chat_id)
+        self.text = text
+        self.caption = None
+        self.command = text[1:].split(" ") if text[:1] in (".", "!") else []
+        self.reply_to_message = reply_to_message
+        self.media_group_id = None
+        self.empty = False
+        self.media = None
+        for kind in MessageMediaType:
+            setattr(self, kind.value, None)
+        if media is not None:
+            self.media = MessageMediaType(media_kind)
+            setattr(self, media_kind, media)
+        self.history = []
+
+    async def _telegram_call(self):
+        await config.telegram.wait()
+        if config.flood_rate and random.random() < config.flood_rate:
+            raise FloodWait(1)
+
+    async def edit_text(self, text, parse_mode=None, **kwargs):
+        await self._telegram_call()
+        if self.history and self.history[-1] == text:
+            raise MessageNotModified()
+        self.history.append(text)
+        self.text = text
+        return self
+
+    edit = edit_text
+
+    async def reply_text(self, text, parse_mode=None, **kwargs):
+        await self._telegram_call()
+        message = FakeMessage(self._client, self.chat.id, text)
+        message.history.append(text)
+        self._client.sent.append(message)
+        return message
+
+    reply = reply_text
+
+    async def delete(self, *args, **kwargs):
+        await config.telegram.wait()
+        self._client.deleted += 1
+
+    async def download(self, in_memory: bool = False, **kwargs):
+        media = getattr(self, self.media.value)
+        return await self._client.download_media(media.file_id, in_memory=in_memory)
+
+
+class FakeClient:
+    """Client with the methods the plugins call, plus completion events for the benchmark."""
+
+    def __init__(self):
+        self.sent = []
+        self.deleted = 0
+        self.files = {}
+        self.messages = {}
+        self._waiters = {}
+
+    # Handler registration, used at import time by the plugin modules
+    @staticmethod
+    def on_message(*args, **kwargs):
+        return lambda func: func
+
+    @staticmethod
+    def on_raw_update(*args, **kwargs):
+        return lambda func: func
+
+    def media(self, payload: bytes, mime_type: str = None, duration: int = 0, thumbs=None, **extra):
+        """Register a payload under a new file id and return a media object for a FakeMessage."""
+        number = next(_file_ids)
+        file_id = f"file{number}"
+        self.files[file_id] = payload
+        return types.SimpleNamespace(
+            file_id=file_id,
+            file_unique_id=f"unique{number}",
+            file_size=len(payload),
+            file_name=None,
+            mime_type=mime_type,
+            duration=duration,
+            thumbs=thumbs,
+            **extra,
+        )
+
+    def wait_for_send(self, chat_id: int) -> asyncio.Future:
+        """Future resolved with the next message sent to a chat through send_* methods."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(chat_id, []).append(future)
+        return future
+
+    def _sent(self, chat_id: int, message):
+        self.sent.append(message)
+        waiters = self._waiters.get(chat_id)
+        if waiters:
+            waiters.pop(0).set_result(message)
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        await config.telegram.wait()
+        message = FakeMessage(self, chat_id, text)
+        self._sent(chat_id, message)
+        return message
+
+    async def send_voice(self, chat_id: int, voice, **kwargs):
+        await config.telegram.wait()
+        message = FakeMessage(self, chat_id)
+        message.voice_bytes = voice.getbuffer().nbytes
+        self._sent(chat_id, message)
+        return message
+
+    async def send_document(self, chat_id: int, document, **kwargs):
+        await config.telegram.wait()
+        message = FakeMessage(self, chat_id)
+        self._sent(chat_id, message)
+        return message
+
+    async def delete_messages(self, chat_id: int, message_ids, **kwargs):
+        await config.telegram.wait()
+        self.deleted += len(message_ids) if isinstance(message_ids, list) else 1
+
+    async def get_messages(self, chat_id: int, message_ids):
+        await config.telegram.wait()
+        return [self.messages.get(message_id) for message_id in message_ids]
+
+    async def get_media_group(self, chat_id: int, message_id: int):
+        await config.telegram.wait()
+        group = self.messages[message_id].media_group_id
+        return [m for m in self.messages.values() if m.media_group_id == group]
+
+    async def download_media(self, file_id: str, in_memory: bool = False, **kwargs):
+        await config.download.wait()
+        payload = self.files[file_id]
+        if in_memory:
+            buffer = BytesIO(payload)
+            buffer.name = file_id
+            return buffer
+        fd, path = tempfile.mkstemp(prefix="bench-")
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+        return path
+
+
+# --- google.generativeai -----------------------------------------------------------------
+
+class FakeFile:
+    _names = itertools.count(1)
+
+    def __init__(self, mime_type, ready_at):
+        self.name = f"files/bench{next(self._names)}"
+        self.mime_type = mime_type
+        self.ready_at = ready_at
+        self.expiration_time = None
+
+    @property
+    def state(self):
+        return types.SimpleNamespace(name="ACTIVE" if time.monotonic() >= self.ready_at else "PROCESSING")
+
+
+_files = {}
+_files_lock = threading.Lock()
+
+
+def upload_file(source, mime_type=None, **kwargs):
+    """Blocking, like the real SDK; the plugins run it in a thread pool."""
+    config.upload.block()
+    uploaded = FakeFile(mime_type, time.monotonic() + config.processing.sample())
+    with _files_lock:
+        _files[uploaded.name] = uploaded
+    return uploaded
+
+
+def get_file(name):
+    config.get_file.block()
+    with _files_lock:
+        return _files[name]
+
+
+def configure(**kwargs):
+    pass
+
+
+def _count_tokens(contents) -> int:
+    tokens = 0
+    for part in contents if isinstance(contents, list) else [contents]:
+        # Gemini bills a fixed 258 tokens per image/video frame, text is ~4 characters a token
+        tokens += len(part) // 4 if isinstance(part, str) else 258
+    return tokens
+
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+        self.parts = [text] if text else []
+
+
+class FakeResponse:
+    """Streamed or complete answer; usage_metadata is filled once the stream is exhausted."""
+
+    def __init__(self, prompt_tokens, chunks):
+        self._prompt_tokens = prompt_tokens
+        self._chunks = chunks
+        self.usage_metadata = None
+
+    def _finish(self, texts):
+        self.usage_metadata = types.SimpleNamespace(
+            prompt_token_count=self._prompt_tokens,
+            candidates_token_count=sum(len(text) // 4 for text in texts),
+        )
+
+    async def __aiter__(self):
+        texts = []
+        for index in range(self._chunks):
+            await (config.first_token if index == 0 else config.token).wait()
+            text = f"word{index} " * 8
+            texts.append(text)
+            yield FakeChunk(text)
+        self._finish(texts)
+
+    async def complete(self):
+        async for _ in self:
+            pass
+        self.text = "".join(f"word{index} " * 8 for index in range(self._chunks))
+        self.parts = [self.text]
+        return self
+
+
+class GenerativeModel:
+    def __init__(self, model_name="gemini-1.5-flash", generation_config=None, **kwargs):
+        self.model_name = model_name if model_name.startswith("models/") else f"models/{model_name}"
+        self._generation_config = generation_config or {}
+
+    async def generate_content_async(self, contents, stream=False, **kwargs):
+        response = FakeResponse(_count_tokens(contents), config.chunks)
+        return response if stream else await response.complete()
+
+
+# --- installation ------------------------------------------------------------------------
+
+class FakeDB:
+    """utils.db stand-in keeping every namespace in memory."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, module, variable, default=None):
+        return self.data.get(module, {}).get(variable, default)
+
+    def set(self, module, variable, value):
+        self.data.setdefault(module, {})[variable] = value
+
+    def remove(self, module, variable):
+        self.data.get(module, {}).pop(variable, None)
+
+    def get_collection(self, module):
+        return dict(self.data.get(module, {}))
+
+
+db = FakeDB()
+
+
+def _module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+def install(**overrides):
+    """
+    Register the fake pyrogram, google.generativeai and utils modules.
+    :param overrides: FakeConfig fields, e.g. processing=Latency(5, 2).
+    :return: The active FakeConfig.
+    """
+    global config
+    config = FakeConfig(**overrides)
+
+    modules_help = {}
+    filters = _module(
+        "pyrogram.filters",
+        command=lambda *args, **kwargs: Filter(),
+        me=Filter(), private=Filter(), group=Filter(), mentioned=Filter(), service=Filter(),
+    )
+    enums = _module("pyrogram.enums", ParseMode=ParseMode, MessageMediaType=MessageMediaType)
+    errors = _module("pyrogram.errors", FloodWait=FloodWait, MessageNotModified=MessageNotModified)
+    pyrogram_types = _module("pyrogram.types", Message=FakeMessage)
+    _module(
+        "pyrogram",
+        Client=FakeClient, ContinuePropagation=ContinuePropagation,
+        filters=filters, enums=enums, errors=errors, types=pyrogram_types,
+    )
+
+    genai = _module(
+        "google.generativeai",
+        configure=configure, upload_file=upload_file, get_file=get_file, GenerativeModel=GenerativeModel,
+    )
+    _module("google", generativeai=genai, __path__=[])
+
+    _module("utils", __path__=[])
+    _module("utils.db", db=db)
+    _module("utils.misc", modules_help=modules_help, prefix=".")
+    _module("utils.config", gemini_key="bench")
+    _module(
+        "utils.scripts",
+        modules_help=modules_help,
+        format_exc=lambda e: f"{type(e).__name__}: {e}",
+        ReplyCheck=lambda message: message.id,
+    )
+    return config
@@ -0,0 +1,114 @@
+"""
+Local HTTP/1.1 server mimicking the ElevenLabs text-to-speech endpoints.
+POST /v1/text-to-speech/{voice_id}[/stream] answers with MP3 audio (a sine tone about as long as
+the text would take to read) sent in chunks, after a configurable time to first byte.
+"""
+import asyncio
+import json
+import random
+from .fakes import Latency
+
+CHARS_PER_SECOND = 15
+CHUNK_SIZE = 4096
+
+
+async def make_mp3(seconds: int) -> bytes:
+    """Encode a sine tone of the given length as MP3 with FFmpeg."""
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-hide_banner", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"sine=frequency=220:duration={seconds}",
+        "-ac", "1", "-c:a", "libmp3lame", "-b:a", "64k", "-f", "mp3", "pipe:1",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    output, errors = await process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError(f"FFmpeg failed: {errors.decode(errors='ignore').strip()}")
+    return output
+
+
+class TTSServer:
+    """
+    :param first_byte: Latency before the first audio bytes of a response.
+    :param chunk_delay: Latency between two chunks, i.e. synthesis speed.
+    :param error_rate: Share of requests answered with 429 and Retry-After: 0.
+    """
+
+    def __init__(self, first_byte=Latency(0.4, 0.2), chunk_delay=Latency(0.02, 0.01), error_rate=0.0):
+        self.first_byte = first_byte
+        self.chunk_delay = chunk_delay
+        self.error_rate = error_rate
+        self.requests = 0
+        self.errors = 0
+        self._audio = {}
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.sockets[0].getsockname()[:2]
+        return f"http://{host}:{port}/v1/text-to-speech"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, "127.0.0.1", 0)
+        return self
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def audio_for(self, text: str) -> bytes:
+        """MP3 tone for a text; generated once per length, so call it ahead of a run to warm up."""
+        seconds = max(1, min(60, round(len(text) / CHARS_PER_SECOND)))
+        if seconds not in self._audio:
+            self._audio[seconds] = asyncio.ensure_future(make_mp3(seconds))
+        return await self._audio[seconds]
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while (line := await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                await self._respond(writer, method, path, headers, body)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, method, path, headers, body):
+        self.requests += 1
+        if method != "POST" or not path.startswith("/v1/text-to-speech/"):
+            return await self._send_error(writer, 404, "Not found")
+        if not headers.get("xi-api-key"):
+            return await self._send_error(writer, 401, "Missing xi-api-key")
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return await self._send_error(writer, 429, "Too many requests", {"Retry-After": "0"})
+
+        audio = await self.audio_for(json.loads(body)["text"])
+        await self.first_byte.wait()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\nContent-Type: audio/mpeg\r\nTransfer-Encoding: chunked\r\n\r\n"
+        )
+        for start in range(0, len(audio), CHUNK_SIZE):
+            chunk = audio[start:start + CHUNK_SIZE]
+            writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            await writer.drain()
+            await self.chunk_delay.wait()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    @staticmethod
+    async def _send_error(writer, status, detail, extra_headers=None):
+        body = json.dumps({"detail": detail}).encode()
+        head = f"HTTP/1.1 {status} Error\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+        for name, value in (extra_headers or {}).items():
+            head += f"{name}: {value}\r\n"
+        writer.write(head.encode() + b"\r\n" + body)
+        await writer.drain()
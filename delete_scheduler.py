@@ -0,0 +1,114 @@
+import asyncio
+import heapq
+import time
+from pyrogram import Client, ContinuePropagation
+from pyrogram.errors import FloodWait
+from .settings_cache import get_settings
+
+# Messages due within this window of each other are deleted in one call per chat.
+BATCH_WINDOW = 1.0
+
+# Handler group of the resume hook; it has a group of its own so it never hides updates from other handlers.
+RESUME_GROUP = -1001
+
+settings = get_settings("custom.scheduler")
+
+_client = None
+_heap = None
+_task = None
+_wakeup = None
+_resumed = False
+
+
+def _load():
+    global _heap
+    if _heap is None:
+        _heap = [tuple(job) for job in settings.get("pending_deletes", [])]
+        heapq.heapify(_heap)
+    return _heap
+
+
+def _save():
+    settings.set("pending_deletes", [list(job) for job in _heap])
+
+
+def ensure_started(client: Client):
+    """Start the deletion loop, resuming jobs persisted before a restart."""
+    global _client, _task, _wakeup
+    _client = client
+    if _task is None or _task.done():
+        _load()
+        _wakeup = asyncio.Event()
+        _task = asyncio.create_task(_run())
+
+
+def schedule_delete(client: Client, chat_id: int, message_ids, delay: float):
+    """
+    Delete messages in a chat after a delay without keeping the caller waiting.
+    :param client: Client used to delete the messages.
+    :param chat_id: Chat the messages belong to.
+    :param message_ids: A message id or a list of them.
+    :param delay: Seconds to wait before deleting.
+    """
+    if isinstance(message_ids, int):
+        message_ids = [message_ids]
+    ensure_started(client)
+    due = time.time() + delay
+    for message_id in message_ids:
+        heapq.heappush(_heap, (due, chat_id, message_id))
+    _save()
+    _wakeup.set()
+
+
+async def _delete_batch(chat_id: int, message_ids: list):
+    # Telegram accepts at most 100 message ids per call
+    for start in range(0, len(message_ids), 100):
+        while True:
+            try:
+                await _client.delete_messages(chat_id, message_ids[start:start + 100])
+                break
+            except FloodWait as e:
+                await asyncio.sleep(e.value)
+            except Exception:
+                # Already deleted, no rights anymore, chat gone... nothing left to do
+                break
+
+
+async def _run():
+    while True:
+        _wakeup.clear()
+        if not _heap:
+            await _wakeup.wait()
+            continue
+        timeout = _heap[0][0] - time.time()
+        if timeout > 0:
+            try:
+                await asyncio.wait_for(_wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        batches = {}
+        deadline = time.time() + BATCH_WINDOW
+        while _heap and _heap[0][0] <= deadline:
+            _, chat_id, message_id = heapq.heappop(_heap)
+            batches.setdefault(chat_id, []).append(message_id)
+        for chat_id, message_ids in batches.items():
+            await _delete_batch(chat_id, message_ids)
+        _save()
+
+
+@Client.on_raw_update(group=RESUME_GROUP)
+async def resume_scheduled_deletes(client: Client, *_):
+    """
+    Pick up deletions persisted before a restart on the first update the client receives,
+    then unregister so later updates don't go through this handler.
+    """
+    global _resumed
+    if not _resumed:
+        _resumed = True
+        if _task is None and settings.get("pending_deletes"):
+            ensure_started(client)
+        for handler, group in getattr(resume_scheduled_deletes, "handlers", []):
+            client.remove_handler(handler, group)
+    raise ContinuePropagation
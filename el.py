@@ -1,50 +1,256 @@
 import os
-import httpx
-import subprocess
+import re
+import json
+import time
+import asyncio
+import logging
+import hashlib
+import importlib.util
+from io import BytesIO
+from collections import OrderedDict
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
 from pyrogram import Client, filters, enums
 from pyrogram.types import Message
 from utils.misc import modules_help, prefix
-from utils.db import db
+from .settings_cache import get_settings
+from .ai_stats import record_bytes, record_timing, stage, timed
+from .provider_scheduler import PRIORITY_HIGH, PRIORITY_NORMAL, get_provider, single_flight
 
 DEFAULT_PARAMS = {
     "voice_id": "21m00Tcm4TlvDq8ikWAM",
     "stability": 0.3,  # Lower stability for realism
     "similarity_boost": 0.9,  # Higher similarity for natural tone
 }
+DEFAULT_WORKERS = 2
+DEFAULT_PARALLEL_CHUNKS = 3
+CHUNK_CHARS = 400
+SPEED = 0.9
+VOLUME = 0.9
+CACHE_DIR = "elevenlabs_cache"
+DEFAULT_CACHE_SIZE_MB = 50
 
-def process_audio(input_path: str, output_path: str, speed: float, volume: float):
+API_URL = "https://api.elevenlabs.io/v1/text-to-speech"
+# httpx.Timeout / httpx.Limits arguments; httpx itself is imported on the first request.
+HTTP_TIMEOUT = {"connect": 5.0, "read": 60.0, "write": 10.0, "pool": 30.0}
+HTTP_LIMITS = {"max_connections": 10, "max_keepalive_connections": 5, "keepalive_expiry": 120}
+MAX_RETRIES = 3
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+_http_client = None
+_http_client_lock = asyncio.Lock()
+
+settings = get_settings("custom.elevenlabs")
+elevenlabs = get_provider("elevenlabs")
+log = logging.getLogger(__name__)
+
+_queue = asyncio.Queue()
+_workers = set()
+_jobs = []
+_last_job_by_chat = {}
+
+
+class TTSJob:
+    """A queued `.el` request. Jobs of the same chat are sent in the order they were queued."""
+
+    def __init__(self, client: Client, chat_id: int, text: str, previous=None):
+        self.client = client
+        self.chat_id = chat_id
+        self.text = text
+        self.previous = previous
+        self.sent = asyncio.Event()
+        self.cancelled = False
+        self.task = None
+
+class TTSCache:
+    """
+    On-disk LRU cache of final processed voice notes, keyed by text and voice parameters.
+    Recency is tracked through file modification times so it survives restarts.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.hits = 0
+        self.misses = 0
+        self._entries = None
+
+    def _load(self) -> OrderedDict:
+        if self._entries is None:
+            os.makedirs(self.directory, exist_ok=True)
+            files = []
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if name.endswith(".ogg") and os.path.isfile(path):
+                    stat = os.stat(path)
+                    files.append((stat.st_mtime, name[:-4], stat.st_size))
+            self._entries = OrderedDict((key, size) for _, key, size in sorted(files))
+        return self._entries
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.ogg")
+
+    @staticmethod
+    def make_key(text: str, params: dict, speed: float, volume: float) -> str:
+        payload = json.dumps(
+            [text, params["voice_id"], params["stability"], params["similarity_boost"], speed, volume]
+        )
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def get(self, key: str):
+        entries = self._load()
+        if key not in entries:
+            self.misses += 1
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+            os.utime(self._path(key))
+        except OSError:
+            entries.pop(key, None)
+            self.misses += 1
+            return None
+        entries.move_to_end(key)
+        self.hits += 1
+        return data
+
+    def set(self, key: str, data: bytes):
+        entries = self._load()
+        tmp_path = self._path(key) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, self._path(key))
+        entries[key] = len(data)
+        entries.move_to_end(key)
+        limit = float(settings.get("cache_size_mb", DEFAULT_CACHE_SIZE_MB)) * 1024 * 1024
+        while entries and self.size > limit:
+            old_key, _ = entries.popitem(last=False)
+            try:
+                os.remove(self._path(old_key))
+            except OSError:
+                pass
+
+    def clear(self) -> int:
+        entries = self._load()
+        count = len(entries)
+        for key in list(entries):
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+        entries.clear()
+        return count
+
+    @property
+    def size(self) -> int:
+        return sum(self._load().values())
+
+    def __len__(self):
+        return len(self._load())
+
+
+tts_cache = TTSCache(CACHE_DIR)
+
+
+def get_voice_params() -> dict:
+    return {key: settings.get(key, DEFAULT_PARAMS[key]) for key in DEFAULT_PARAMS}
+
+
+async def process_audio(chunks, speed: float, volume: float) -> bytes:
     """
-    Process the audio file using FFmpeg.
-    Adjusts speed, volume, and applies filters for natural sound.
-    :param input_path: Path to the original audio file.
-    :param output_path: Path to save the processed audio file.
+    Process the audio stream using FFmpeg.
+    Adjusts speed, volume, and applies filters for natural sound, encoding to an OGG/Opus voice note.
+    Input is piped into FFmpeg as it arrives, so encoding overlaps with the download.
+    :param chunks: Async iterator of the original audio bytes.
     :param speed: Speed adjustment factor (e.g., 1.0 for normal speed, 0.9 for slower).
     :param volume: Volume adjustment factor (e.g., 1.0 for no change, 0.8 for reduced volume).
+    :return: The encoded OGG/Opus audio.
     """
-    subprocess.run(
-        [
-            "ffmpeg",
-            "-i", input_path,
-            "-filter:a",
-            f"atempo={speed},volume={volume},acompressor=threshold=-20dB:ratio=2.5:attack=5:release=50",
-            "-vn",  # No video
-            output_path,
-        ],
-        check=True
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg",
+        "-hide_banner", "-loglevel", "error",
+        "-i", "pipe:0",
+        "-filter:a",
+        f"atempo={speed},volume={volume},acompressor=threshold=-20dB:ratio=2.5:attack=5:release=50",
+        "-vn",  # No video
+        "-c:a", "libopus", "-b:a", "64k",
+        "-f", "ogg",
+        "pipe:1",
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+
+    async def feed():
+        try:
+            async for chunk in chunks:
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+        finally:
+            process.stdin.close()
+
+    try:
+        _, output, errors = await asyncio.gather(feed(), process.stdout.read(), process.stderr.read())
+    except BaseException:
+        process.kill()
+        await process.wait()
+        raise
+    if await process.wait() != 0:
+        raise RuntimeError(f"FFmpeg failed: {errors.decode(errors='ignore').strip()}")
+    return output
+
+def _create_http_client():
+    import httpx
+
+    return httpx.AsyncClient(
+        http2=importlib.util.find_spec("h2") is not None,
+        timeout=httpx.Timeout(**HTTP_TIMEOUT),
+        limits=httpx.Limits(**HTTP_LIMITS),
     )
 
-async def generate_elevenlabs_audio(text: str):
+async def get_http_client():
+    """
+    Return the shared keep-alive httpx.AsyncClient, creating it on first use.
+    Importing httpx and loading the CA bundle take about a second, so that happens in a thread.
+    HTTP/2 is enabled when the optional `h2` package is installed.
+    """
+    global _http_client
+    async with _http_client_lock:
+        if _http_client is None or _http_client.is_closed:
+            _http_client = await asyncio.to_thread(_create_http_client)
+    return _http_client
+
+def get_retry_delay(response, attempt: int) -> float:
+    """Honour Retry-After (seconds or HTTP date) and fall back to exponential backoff."""
+    retry_after = response.headers.get("Retry-After") if response is not None else None
+    delay = RETRY_BASE_DELAY * 2 ** attempt
+    if retry_after:
+        try:
+            delay = float(retry_after)
+        except ValueError:
+            try:
+                delay = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                pass
+    return min(max(delay, 0), RETRY_MAX_DELAY)
+
+async def stream_elevenlabs_audio(text: str, params: dict, stream: bool = True, priority: int = PRIORITY_NORMAL):
     """
     Generate audio using ElevenLabs API with adjusted parameters.
+    Requests go through the shared ElevenLabs limits (the text length counts as tokens).
+    429, 5xx and connection errors are retried with backoff until the first byte arrives;
+    a 429 holds back all ElevenLabs requests for the retry delay.
     :param text: Text to convert to speech.
-    :return: Path to the generated audio file.
+    :param params: Voice parameters (voice_id, stability, similarity_boost).
+    :param stream: Use the /stream endpoint so bytes arrive before synthesis finishes.
+    :param priority: Admission priority, see provider_scheduler.
+    :return: Async iterator over the generated MP3 bytes.
     """
-    api_key = db.get("custom.elevenlabs", "api_key")
+    api_key = settings.get("api_key")
     if not api_key:
         raise ValueError(f"ElevenLabs `api_key` is not configured. Use `{prefix}set_elevenlabs` to set it.")
 
-    params = {key: db.get("custom.elevenlabs", key, DEFAULT_PARAMS[key]) for key in DEFAULT_PARAMS}
-
     headers = {
         "xi-api-key": api_key,
         "Content-Type": "application/json",
@@ -58,22 +264,192 @@ async def generate_elevenlabs_audio(text: str):
     }
 
     voice_id = params["voice_id"]
-    original_audio_path = "elevenlabs_voice.mp3"
+    url = f"{API_URL}/{voice_id}/stream" if stream else f"{API_URL}/{voice_id}"
+    client = await get_http_client()
+    # Already loaded by get_http_client() off the event loop, so this is only a lookup
+    import httpx
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(
-            f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}",
-            headers=headers,
-            json=data,
-        )
+    requested = time.perf_counter()
 
-        if response.status_code == 200:
-            with open(original_audio_path, "wb") as f:
-                f.write(response.content)
-        else:
-            raise ValueError(f"Error from ElevenLabs API: {response.text}")
+    for attempt in range(MAX_RETRIES + 1):
+        response = None
+        started = False
+        try:
+            async with elevenlabs.slot(priority, len(text)), client.stream("POST", url, headers=headers, json=data) as response:
+                if response.status_code == 200:
+                    async for chunk in response.aiter_bytes():
+                        if not started:
+                            record_timing("el.first_byte", time.perf_counter() - requested)
+                        started = True
+                        yield chunk
+                    return
+                await response.aread()
+                if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+                    raise ValueError(f"Error from ElevenLabs API: {response.text}")
+        except httpx.TransportError:
+            if started or attempt == MAX_RETRIES:
+                raise
+        delay = get_retry_delay(response, attempt)
+        if response is not None and response.status_code == 429:
+            elevenlabs.backoff(delay)
+        await asyncio.sleep(delay)
 
-    return original_audio_path
+def split_text(text: str, max_chars: int = CHUNK_CHARS) -> list:
+    """
+    Split text into chunks of at most max_chars, cutting at sentence, then clause, then word boundaries.
+    """
+    chunks = []
+    current = ""
+    for sentence in re.split(r"(?<=[.!?…])\s+", text.strip()):
+        pieces = [sentence]
+        if len(sentence) > max_chars:
+            pieces = re.split(r"(?<=[,;:])\s+", sentence)
+        for piece in pieces:
+            while len(piece) > max_chars:
+                cut = piece.rfind(" ", 0, max_chars)
+                cut = cut if cut > 0 else max_chars
+                if current:
+                    chunks.append(current)
+                    current = ""
+                chunks.append(piece[:cut].strip())
+                piece = piece[cut:].strip()
+            if current and len(current) + 1 + len(piece) > max_chars:
+                chunks.append(current)
+                current = piece
+            else:
+                current = f"{current} {piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+async def stream_chunked_audio(text: str, params: dict):
+    """
+    Synthesize long text as sentence chunks in parallel and yield the MP3 parts in order.
+    MP3 frames concatenate cleanly, so FFmpeg decodes the joined parts as one input
+    (the same thing its concat protocol does), and parts are fed as soon as they finish.
+    :param text: Text to convert to speech.
+    :param params: Voice parameters (voice_id, stability, similarity_boost).
+    :return: Async iterator over the generated MP3 bytes.
+    """
+    chunks = split_text(text)
+    if len(chunks) <= 1:
+        # Short texts are admitted ahead of the chunks of long ones
+        async for chunk in stream_elevenlabs_audio(text, params, priority=PRIORITY_HIGH):
+            yield chunk
+        return
+
+    semaphore = asyncio.Semaphore(get_int_setting("parallel", DEFAULT_PARALLEL_CHUNKS))
+
+    async def synthesize(chunk: str) -> bytes:
+        async with semaphore:
+            return b"".join([part async for part in stream_elevenlabs_audio(chunk, params)])
+
+    tasks = [asyncio.create_task(synthesize(chunk)) for chunk in chunks]
+    try:
+        for task in tasks:
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+def get_int_setting(key: str, default: int) -> int:
+    return max(1, int(settings.get(key, default)))
+
+def get_worker_count() -> int:
+    return get_int_setting("workers", DEFAULT_WORKERS)
+
+
+def enqueue_tts(client: Client, chat_id: int, text: str) -> TTSJob:
+    """
+    Queue a TTS job and make sure enough workers are running.
+    Synthesis runs in parallel up to the worker limit; sending stays in per-chat order.
+    """
+    previous = _last_job_by_chat.get(chat_id)
+    job = TTSJob(client, chat_id, text, previous.sent if previous else None)
+    _last_job_by_chat[chat_id] = job
+    _jobs.append(job)
+    _queue.put_nowait(job)
+    while len(_workers) < get_worker_count():
+        worker = asyncio.create_task(_tts_worker())
+        _workers.add(worker)
+        worker.add_done_callback(_workers.discard)
+    return job
+
+
+def cancel_tts(chat_id: int) -> int:
+    """Cancel the queued and running TTS jobs of a chat. Returns how many were cancelled."""
+    count = 0
+    for job in list(_jobs):
+        if job.chat_id == chat_id and not job.cancelled:
+            job.cancelled = True
+            if job.task:
+                job.task.cancel()
+            count += 1
+    return count
+
+
+async def _tts_worker():
+    while True:
+        job = await _queue.get()
+        try:
+            if not job.cancelled:
+                job.task = asyncio.create_task(_run_tts_job(job))
+                try:
+                    await job.task
+                except asyncio.CancelledError:
+                    if not job.task.cancelled():
+                        raise
+                except Exception:
+                    # Never let one job take the worker down with it
+                    log.exception("TTS job for chat %s failed", job.chat_id)
+        finally:
+            job.sent.set()
+            _jobs.remove(job)
+            if _last_job_by_chat.get(job.chat_id) is job:
+                del _last_job_by_chat[job.chat_id]
+            _queue.task_done()
+        if len(_workers) > get_worker_count():
+            _workers.discard(asyncio.current_task())
+            return
+
+
+async def synthesize_voice(text: str, params: dict, cache_key: str) -> bytes:
+    """Generate and process the audio in one pass, without intermediate files, and cache the voice note."""
+    with stage("el.synthesize"):
+        audio = await process_audio(stream_chunked_audio(text, params), speed=SPEED, volume=VOLUME)
+    tts_cache.set(cache_key, audio)
+    return audio
+
+@timed("el.total")
+async def _run_tts_job(job: TTSJob):
+    try:
+        params = get_voice_params()
+        cache_key = TTSCache.make_key(job.text, params, SPEED, VOLUME)
+        audio = tts_cache.get(cache_key)
+        if audio is None:
+            # The same text requested concurrently (e.g. in several chats) is synthesized once
+            audio = await single_flight(("elevenlabs", cache_key), lambda: synthesize_voice(job.text, params, cache_key))
+        record_bytes("el.voice", len(audio))
+        voice = BytesIO(audio)
+        voice.name = "voice.ogg"
+
+        # Keep per-chat order: wait until the previous job of this chat has been sent
+        if job.previous:
+            await job.previous.wait()
+
+        # Send the processed audio
+        with stage("el.send"):
+            await job.client.send_voice(chat_id=job.chat_id, voice=voice)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        if job.previous:
+            await job.previous.wait()
+        try:
+            await job.client.send_message(job.chat_id, f"Error: {e}", parse_mode=enums.ParseMode.MARKDOWN)
+        except Exception:
+            log.warning("Could not report TTS error to chat %s: %s", job.chat_id, e)
 
 @Client.on_message(filters.command(["elevenlabs", "el"], prefix))
 async def elevenlabs_command(client: Client, message: Message):
@@ -92,23 +468,48 @@ async def elevenlabs_command(client: Client, message: Message):
 
     text = " ".join(message.command[1:]).strip()
     await message.delete()
+    enqueue_tts(client, message.chat.id, text)
 
-    try:
-        # Generate audio
-        original_audio_path = await generate_elevenlabs_audio(text)
+@Client.on_message(filters.command(["el_queue", "elq"], prefix) & filters.me)
+async def elevenlabs_queue(_, message: Message):
+    """
+    Show the TTS queue depth or cancel this chat's queued jobs.
+    """
+    if len(message.command) > 1 and message.command[1].lower() == "cancel":
+        count = cancel_tts(message.chat.id)
+        await message.edit_text(f"**Cancelled {count} ElevenLabs job(s) in this chat.**", parse_mode=enums.ParseMode.MARKDOWN)
+        return
 
-        # Process the audio
-        processed_audio_path = "elevenlabs_voice_processed.mp3"
-        process_audio(original_audio_path, processed_audio_path, speed=0.9, volume=0.9)
+    running = sum(1 for job in _jobs if job.task)
+    chat_jobs = sum(1 for job in _jobs if job.chat_id == message.chat.id)
+    await message.edit_text(
+        "**ElevenLabs Queue:**\n\n"
+        f"**Running**: `{running}`\n"
+        f"**Waiting**: `{len(_jobs) - running}`\n"
+        f"**In this chat**: `{chat_jobs}`\n"
+        f"**Workers**: `{len(_workers)}/{get_worker_count()}`",
+        parse_mode=enums.ParseMode.MARKDOWN,
+    )
 
-        # Send the processed audio
-        await client.send_voice(chat_id=message.chat.id, voice=processed_audio_path)
+@Client.on_message(filters.command(["el_cache", "elc"], prefix) & filters.me)
+async def elevenlabs_cache(_, message: Message):
+    """
+    Show TTS cache statistics or purge the cache.
+    """
+    if len(message.command) > 1 and message.command[1].lower() in ["clear", "purge"]:
+        count = tts_cache.clear()
+        await message.edit_text(f"**Removed {count} cached voice note(s).**", parse_mode=enums.ParseMode.MARKDOWN)
+        return
 
-        # Clean up
-        os.remove(original_audio_path)
-        os.remove(processed_audio_path)
-    except Exception as e:
-        await client.send_message(message.chat.id, f"Error: {e}", parse_mode=enums.ParseMode.MARKDOWN)
+    limit = float(settings.get("cache_size_mb", DEFAULT_CACHE_SIZE_MB))
+    await message.edit_text(
+        "**ElevenLabs Cache:**\n\n"
+        f"**Entries**: `{len(tts_cache)}`\n"
+        f"**Size**: `{tts_cache.size / 1024 / 1024:.2f}/{limit:g} MB`\n"
+        f"**Hits**: `{tts_cache.hits}`\n"
+        f"**Misses**: `{tts_cache.misses}`",
+        parse_mode=enums.ParseMode.MARKDOWN,
+    )
 
 @Client.on_message(filters.command(["set_elevenlabs", "set_el"], prefix) & filters.me)
 async def set_elevenlabs_config(_, message: Message):
@@ -117,15 +518,18 @@ async def set_elevenlabs_config(_, message: Message):
     """
     args = message.command
     if len(args) == 1:
-        current_values = {key: db.get("custom.elevenlabs", key, DEFAULT_PARAMS[key]) for key in DEFAULT_PARAMS}
-        api_key = db.get("custom.elevenlabs", "api_key", "Not Set")
+        current_values = {key: settings.get(key, DEFAULT_PARAMS[key]) for key in DEFAULT_PARAMS}
+        api_key = settings.get("api_key", "Not Set")
         response = (
             "**ElevenLabs Configuration:**\n\n"
             f"**api_key**: `{api_key}`\n"
             + "\n".join([f"**{key}**: `{value}`" for key, value in current_values.items()])
+            + f"\n**workers**: `{get_worker_count()}`"
+            + f"\n**parallel**: `{get_int_setting('parallel', DEFAULT_PARALLEL_CHUNKS)}`"
+            + f"\n**cache_size_mb**: `{settings.get('cache_size_mb', DEFAULT_CACHE_SIZE_MB)}`"
             + "\n\n**Usage:**\n"
             f"`{prefix}set_elevenlabs [key] [value]`\n"
-            "**Keys:** `api_key`, `voice_id`, `stability`, `similarity_boost`"
+            "**Keys:** `api_key`, `voice_id`, `stability`, `similarity_boost`, `workers`, `parallel`, `cache_size_mb`"
         )
         await message.edit_text(response, parse_mode=enums.ParseMode.MARKDOWN)
         return
@@ -141,22 +545,32 @@ async def set_elevenlabs_config(_, message: Message):
 
     key = args[1].lower()
     value = " ".join(args[2:])
-    if key not in ["api_key", *DEFAULT_PARAMS.keys()]:
+    if key not in ["api_key", "workers", "parallel", "cache_size_mb", *DEFAULT_PARAMS.keys()]:
         await message.edit_text(
             "**Invalid Key:**\n"
-            "Allowed keys are: `api_key`, `voice_id`, `stability`, `similarity_boost`.",
+            "Allowed keys are: `api_key`, `voice_id`, `stability`, `similarity_boost`, `workers`, `parallel`, `cache_size_mb`.",
             parse_mode=enums.ParseMode.MARKDOWN,
         )
         return
 
-    if key in ["stability", "similarity_boost"]:
+    if key in ["stability", "similarity_boost", "cache_size_mb"]:
         try:
             value = float(value)
         except ValueError:
             await message.edit_text(f"`{key}` must be a numeric value (float).", parse_mode=enums.ParseMode.MARKDOWN)
             return
 
-    db.set("custom.elevenlabs", key, value)
+    if key in ["workers", "parallel"]:
+        if not value.isdigit() or int(value) < 1:
+            await message.edit_text(f"`{key}` must be a positive integer.", parse_mode=enums.ParseMode.MARKDOWN)
+            return
+        value = int(value)
+
+    old_value = settings.get(key, DEFAULT_PARAMS.get(key))
+    settings.set(key, value)
+    if key in DEFAULT_PARAMS and value != old_value:
+        # Cached voice notes were rendered with the old voice settings
+        tts_cache.clear()
     await message.edit_text(
         f"**ElevenLabs {key} updated successfully!**\nNew value: `{value}`",
         parse_mode=enums.ParseMode.MARKDOWN,
@@ -166,4 +580,6 @@ modules_help["elevenlabs"] = {
     "el [text]*": "Generate a voice message using ElevenLabs API.",
     "set_el": "View or update ElevenLabs configuration parameters.",
     "set_el <key> <value>": "Set a specific ElevenLabs parameter.",
+    "elq [cancel]": "Show the ElevenLabs job queue or cancel this chat's pending jobs.",
+    "elc [clear]": "Show ElevenLabs voice cache statistics or purge the cache.",
 }
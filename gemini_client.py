@@ -0,0 +1,428 @@
+import asyncio
+import functools
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import OrderedDict
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from utils.config import gemini_key
+from .settings_cache import get_settings
+from .ai_media import (
+    FileProcessingError,
+    downloaded_media,
+    media_mime_type,
+    media_unique_id,
+    reduce_media,
+    source_size,
+)
+from .ai_stats import record_bytes, record_timing, record_usage, stage
+from .provider_scheduler import PRIORITY_HIGH, PRIORITY_LOW, PRIORITY_NORMAL, flight, get_provider, join, single_flight
+
+# Rough prompt token estimates used for admission until Gemini reports the real usage.
+TEXT_CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 258
+FILE_TOKENS = {"audio": 32 * 300, "video": 263 * 120}
+OUTPUT_TOKENS = 500
+
+# Shared model registry: name -> (Gemini model, generation config). Models are built on first use.
+MODELS = {
+    "default": ("gemini-1.5-flash-latest", None),
+    "cook": (
+        "gemini-1.5-flash-latest",
+        {"temperature": 0.35, "top_p": 0.95, "top_k": 40, "max_output_tokens": 1024},
+    ),
+    "process": ("gemini-1.5-flash", None),
+}
+
+# Blocking SDK calls (upload_file / get_file) run here so they never stall the event loop.
+MAX_WORKERS = 4
+POLL_INITIAL_DELAY = 1.0
+POLL_MAX_DELAY = 15.0
+POLL_TIMEOUT = 600
+
+# Uploaded files are reused across commands; Gemini deletes them after 48 hours.
+FILE_TTL = 48 * 3600
+FILE_TTL_MARGIN = 3600
+FILE_CACHE_SIZE = 200
+
+# Answers to identical (media, prompt, model, generation_config) requests.
+RESPONSE_TTL = 7 * 24 * 3600
+RESPONSE_CACHE_SIZE = 300
+NO_CACHE_FLAG = "--nocache"
+# Recency updates of cache hits are written at most once every SAVE_DELAY seconds.
+SAVE_DELAY = 5
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="gemini")
+
+
+class PersistentLRU:
+    """
+    Small LRU mapping with per-entry expiry, persisted in utils.db as one variable per entry
+    plus an index variable holding the keys from least to most recently used.
+    """
+
+    def __init__(self, variable, max_size, ttl):
+        self.variable = variable
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = None
+        self._save_task = None
+
+    @property
+    def _settings(self):
+        return get_settings("custom.gemini")
+
+    def _entry_variable(self, key):
+        return f"{self.variable}:{key}"
+
+    def _load(self):
+        if self._entries is None:
+            index = self._settings.get(self.variable, []) or []
+            if isinstance(index, dict):
+                index = self._migrate(index)
+            self._entries = OrderedDict()
+            for key in index:
+                entry = self._settings.get(self._entry_variable(key))
+                if entry:
+                    self._entries[key] = entry
+        return self._entries
+
+    def _migrate(self, entries):
+        """Split a cache stored as a single {key: entry} variable into per-entry variables."""
+        index = [key for key, _ in sorted(entries.items(), key=lambda item: item[1].get("used", 0))]
+        for key in index:
+            self._settings.set(self._entry_variable(key), entries[key])
+        self._settings.set(self.variable, index)
+        return index
+
+    def _save(self):
+        """Write the index; entries are written on their own when they change."""
+        self._settings.set(self.variable, list(self._entries))
+
+    def _schedule_save(self):
+        """Coalesce the index writes of a burst of cache hits into one write after SAVE_DELAY seconds."""
+        if self._save_task is not None and not self._save_task.done():
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return self._save()
+
+        async def delayed_save():
+            await asyncio.sleep(SAVE_DELAY)
+            self._save()
+
+        self._save_task = loop.create_task(delayed_save())
+
+    def get(self, key):
+        entries = self._load()
+        entry = entries.get(key)
+        if entry and entry["expires"] <= time.time():
+            self.remove(key)
+            entry = None
+        if not entry:
+            self.misses += 1
+            return None
+        self.hits += 1
+        entries.move_to_end(key)
+        self._schedule_save()
+        return entry
+
+    def set(self, key, value, expires=None):
+        entries = self._load()
+        entry = {**value, "expires": expires or time.time() + self.ttl}
+        entries[key] = entry
+        entries.move_to_end(key)
+        self._settings.set(self._entry_variable(key), entry)
+        while len(entries) > self.max_size:
+            evicted, _ = entries.popitem(last=False)
+            self._settings.remove(self._entry_variable(evicted))
+        self._save()
+
+    def remove(self, key):
+        if self._load().pop(key, None) is not None:
+            self._settings.remove(self._entry_variable(key))
+            self._save()
+
+    def clear(self):
+        for key in self._load():
+            self._settings.remove(self._entry_variable(key))
+        self._entries = OrderedDict()
+        self.hits = self.misses = 0
+        self._save()
+
+    def __len__(self):
+        return len(self._load())
+
+
+file_cache = PersistentLRU("file_cache", FILE_CACHE_SIZE, FILE_TTL)
+response_cache = PersistentLRU("response_cache", RESPONSE_CACHE_SIZE, RESPONSE_TTL)
+
+
+gemini = get_provider("gemini")
+
+_genai = None
+_models = {}
+_init_lock = threading.Lock()
+
+
+def get_genai():
+    """Import and configure the Gemini SDK on first use, so loading the plugins stays cheap."""
+    global _genai
+    with _init_lock:
+        if _genai is None:
+            import google.generativeai as genai
+
+            genai.configure(api_key=gemini_key)
+            _genai = genai
+    return _genai
+
+
+def get_model(name):
+    """Return the shared GenerativeModel registered under `name` in MODELS, building it on first use."""
+    if name not in _models:
+        genai = get_genai()
+        with _init_lock:
+            if name not in _models:
+                model_name, generation_config = MODELS[name]
+                _models[name] = genai.GenerativeModel(model_name=model_name, generation_config=generation_config)
+    return _models[name]
+
+
+async def run_blocking(func, *args, **kwargs):
+    """Run a blocking call in the bounded Gemini thread pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_executor, functools.partial(func, *args, **kwargs))
+
+
+async def load_genai():
+    """get_genai() for coroutines: the first call imports the SDK (about a second) in the thread pool."""
+    return _genai if _genai is not None else await run_blocking(get_genai)
+
+
+async def load_model(name):
+    """get_model() for coroutines, building the model in the thread pool on first use."""
+    return _models[name] if name in _models else await run_blocking(get_model, name)
+
+
+async def upload_file(source, file_type="file", on_processing=None, mime_type=None):
+    """
+    Upload a file to Gemini and wait until it leaves the PROCESSING state.
+    Polling backs off exponentially with jitter.
+    :param source: Path of the file to upload, or an in-memory buffer.
+    :param file_type: Human readable file kind used in error messages.
+    :param on_processing: Optional coroutine function awaited once if the file needs processing.
+    :param mime_type: MIME type of the file; required for in-memory buffers.
+    :return: The uploaded Gemini file handle.
+    """
+    record_bytes("gemini.upload", source_size(source))
+    genai = await load_genai()
+    with stage("gemini.upload"):
+        uploaded_file = await run_blocking(genai.upload_file, source, mime_type=mime_type)
+    started = time.perf_counter()
+    delay = POLL_INITIAL_DELAY
+    waited = 0.0
+    notified = False
+    while uploaded_file.state.name == "PROCESSING":
+        if on_processing and not notified:
+            notified = True
+            await on_processing()
+        if waited >= POLL_TIMEOUT:
+            raise FileProcessingError(f"{file_type.capitalize()} processing timed out")
+        sleep_for = delay * random.uniform(0.5, 1.5)
+        await asyncio.sleep(sleep_for)
+        waited += sleep_for
+        delay = min(delay * 2, POLL_MAX_DELAY)
+        uploaded_file = await run_blocking(genai.get_file, uploaded_file.name)
+    record_timing("gemini.processing", time.perf_counter() - started)
+    if uploaded_file.state.name == "FAILED":
+        raise FileProcessingError(f"{file_type.capitalize()} failed to process")
+    return uploaded_file
+
+
+def request_cost(contents):
+    """
+    Estimate the admission priority and token cost of a generate request.
+    Image and text prompts run first, then audio and documents, then video.
+    :return: (priority, tokens)
+    """
+    priority, tokens = PRIORITY_HIGH, OUTPUT_TOKENS
+    for part in contents if isinstance(contents, list) else [contents]:
+        if isinstance(part, str):
+            tokens += len(part) // TEXT_CHARS_PER_TOKEN
+        elif isinstance(part, dict):
+            tokens += IMAGE_TOKENS
+        else:
+            kind = (getattr(part, "mime_type", None) or "").split("/")[0]
+            tokens += FILE_TOKENS.get(kind, IMAGE_TOKENS)
+            priority = max(priority, PRIORITY_LOW if kind == "video" else PRIORITY_NORMAL)
+    return priority, tokens
+
+
+def _record_usage(ticket, response, model):
+    record_usage(response, model)
+    usage = getattr(response, "usage_metadata", None)
+    if usage:
+        ticket.record((usage.prompt_token_count or 0) + (usage.candidates_token_count or 0))
+
+
+async def generate(model, contents):
+    """Generate content with a registered model once the Gemini limits allow it."""
+    gemini_model = await load_model(model)
+    async with gemini.slot(*request_cost(contents)) as ticket:
+        with stage("gemini.generate"):
+            response = await gemini_model.generate_content_async(contents)
+        _record_usage(ticket, response, model)
+    return response
+
+
+async def _cached_file(key):
+    """Return a still-active Gemini file for the given key, validating it with get_file."""
+    entry = file_cache.get(key)
+    if not entry:
+        return None
+    try:
+        genai = await load_genai()
+        uploaded_file = await run_blocking(genai.get_file, entry["name"])
+    except Exception:
+        file_cache.remove(key)
+        return None
+    if uploaded_file.state.name != "ACTIVE":
+        file_cache.remove(key)
+        return None
+    return uploaded_file
+
+
+async def upload_media(reply, file_type="file", on_processing=None, reduction=None):
+    """
+    Upload the media of a Telegram message to Gemini, reusing a previous upload when possible.
+    Cache hits skip both the Telegram download and the Gemini upload.
+    :param reply: Message containing the media.
+    :param file_type: Human readable file kind used in error messages.
+    :param on_processing: Optional coroutine function awaited once if the file needs processing.
+    :param reduction: Optional ai_media.REDUCTIONS key to shrink the media with FFmpeg before upload.
+    :return: The uploaded Gemini file handle.
+    """
+    key = media_unique_id(reply)
+    if key and reduction:
+        key = f"{key}:{reduction}"
+    if not key:
+        return await _upload_media(reply, key, file_type, on_processing, reduction)
+    # The same media requested by concurrent commands is uploaded once
+    return await single_flight(
+        ("gemini.upload", key), lambda: _upload_media(reply, key, file_type, on_processing, reduction)
+    )
+
+
+async def _upload_media(reply, key, file_type, on_processing, reduction):
+    if key:
+        uploaded_file = await _cached_file(key)
+        if uploaded_file:
+            return uploaded_file
+
+    async with downloaded_media(reply, file_type, in_memory=False if reduction else None) as source:
+        mime_type = media_mime_type(reply)
+        reduced = await reduce_media(source, reduction) if reduction else None
+        if reduced:
+            source, mime_type = reduced
+        uploaded_file = await upload_file(source, file_type, on_processing, mime_type=mime_type)
+
+    if key:
+        expiration = getattr(uploaded_file, "expiration_time", None)
+        expires = expiration.timestamp() if expiration else time.time() + FILE_TTL
+        file_cache.set(key, {"name": uploaded_file.name}, expires=expires - FILE_TTL_MARGIN)
+    return uploaded_file
+
+
+def response_cache_key(model, prompt, media_key):
+    """
+    Build the response cache key from media identity, prompt, model name and generation config.
+    Only the MODELS entry is read, so cache hits never load the SDK.
+    """
+    if not media_key:
+        return None
+    model_name, generation_config = MODELS[model]
+    payload = json.dumps([media_key, prompt, model_name, generation_config or {}], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def cached_response(cache_key):
+    """Return a cached answer for the key, or None. Callers check this before downloading any media."""
+    if not cache_key:
+        return None
+    entry = response_cache.get(cache_key)
+    return entry["text"] if entry else None
+
+
+async def generate_text(model, contents, cache_key=None):
+    """
+    Generate a text answer and store it in the response cache.
+    :param model: Name of the model in MODELS.
+    :param contents: Prompt and media parts.
+    :param cache_key: Key from response_cache_key(), or None to bypass the cache.
+    :return: The answer text (may be empty).
+    """
+    if cache_key:
+        # Identical concurrent requests share one Gemini call
+        return await single_flight(("gemini", cache_key), lambda: _generate_text(model, contents, cache_key))
+    return await _generate_text(model, contents)
+
+
+async def _generate_text(model, contents, cache_key=None):
+    response = await generate(model, contents)
+    text = response.text if response and response.parts else ""
+    if cache_key and text:
+        response_cache.set(cache_key, {"text": text})
+    return text
+
+
+async def stream_text(model, contents, cache_key=None):
+    """
+    Stream an answer from Gemini as text deltas and store the full answer in the response cache.
+    :param model: Name of the model in MODELS.
+    :param contents: Prompt and media parts.
+    :param cache_key: Key from response_cache_key(), or None to bypass the cache.
+    """
+    if cache_key:
+        # An identical request already running is awaited and its full answer shown at once
+        joined, text = await join(("gemini", cache_key))
+        if joined:
+            if text:
+                yield text
+            return
+
+    with flight(("gemini", cache_key)) if cache_key else nullcontext() as shared:
+        gemini_model = await load_model(model)
+        async with gemini.slot(*request_cost(contents)) as ticket:
+            started = time.perf_counter()
+            response = await gemini_model.generate_content_async(contents, stream=True)
+            parts = []
+            async for chunk in response:
+                text = chunk.text if chunk.parts else ""
+                if text:
+                    if not parts:
+                        record_timing("gemini.first_token", time.perf_counter() - started)
+                    parts.append(text)
+                    yield text
+            record_timing("gemini.generate", time.perf_counter() - started)
+            _record_usage(ticket, response, model)
+        text = "".join(parts)
+        if cache_key and text:
+            response_cache.set(cache_key, {"text": text})
+        if shared:
+            shared.set_result(text)
+
+
+def parse_cache_flag(message):
+    """Return the command argument text without the no-cache flag, and whether caching is allowed."""
+    args = message.text.split(maxsplit=1)[1] if len(message.command) > 1 else ""
+    words = args.split(" ")
+    use_cache = NO_CACHE_FLAG not in words
+    if not use_cache:
+        args = " ".join(word for word in words if word != NO_CACHE_FLAG).strip()
+    return args, use_cache
@@ -0,0 +1,255 @@
+import asyncio
+import heapq
+import itertools
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from pyrogram import Client, filters
+from pyrogram.types import Message
+from utils.misc import modules_help, prefix
+from .settings_cache import get_settings
+from .ai_stats import record_timing
+
+# RPM/TPM limits are enforced over a sliding window of this many seconds.
+WINDOW = 60
+
+# Lower priorities are admitted first: short image and text prompts go ahead of long media jobs.
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# 0 disables a limit. ElevenLabs "tokens" are characters.
+DEFAULT_LIMITS = {
+    "gemini": {"rpm": 15, "tpm": 1_000_000, "concurrency": 4},
+    "elevenlabs": {"rpm": 0, "tpm": 0, "concurrency": 4},
+}
+LIMIT_NAMES = ("rpm", "tpm", "concurrency")
+
+settings = get_settings("custom.providers")
+
+
+class Ticket:
+    """Admission of one request. record() replaces the token estimate with the real usage."""
+
+    def __init__(self, entry: list):
+        self._entry = entry
+
+    def record(self, tokens: int):
+        self._entry[1] = tokens
+
+
+class Provider:
+    """
+    Admission control for one upstream API: requests wait in a priority queue until
+    the concurrency, requests-per-minute and tokens-per-minute limits allow them to start.
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.active = 0
+        self._window = deque()  # [admitted_at, tokens] of the requests started in the last WINDOW seconds
+        self._waiters = []  # heap of (priority, sequence, tokens, future)
+        self._sequence = itertools.count()
+        self._paused_until = 0.0
+        self._timer = None
+
+    @property
+    def limits(self) -> dict:
+        return {**DEFAULT_LIMITS.get(self.name, {}), **settings.get(self.name, {})}
+
+    @property
+    def queued(self) -> int:
+        return sum(not future.done() for *_, future in self._waiters)
+
+    def usage(self) -> tuple:
+        """Requests and tokens admitted during the last WINDOW seconds."""
+        self._expire(time.monotonic())
+        return len(self._window), sum(tokens for _, tokens in self._window)
+
+    def backoff(self, seconds: float):
+        """Stop admitting requests for a while, e.g. after the provider answered 429."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def _expire(self, now: float):
+        while self._window and self._window[0][0] <= now - WINDOW:
+            self._window.popleft()
+
+    def _delay(self, tokens: int, now: float) -> float:
+        """Seconds until a request of `tokens` fits the rate limits, 0 if it can start now."""
+        if now < self._paused_until:
+            return self._paused_until - now
+        limits = self.limits
+        rpm, tpm = limits["rpm"], limits["tpm"]
+        if rpm and len(self._window) >= rpm:
+            return self._window[len(self._window) - rpm][0] + WINDOW - now
+        excess = sum(count for _, count in self._window) + tokens - tpm
+        if tpm and self._window and excess > 0:
+            # Wait until enough of the oldest requests leave the window. A request larger than
+            # the whole budget waits for an empty window instead of forever.
+            for admitted_at, count in self._window:
+                excess -= count
+                if excess <= 0:
+                    break
+            return admitted_at + WINDOW - now
+        return 0.0
+
+    def _dispatch(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        self._expire(now)
+        while self._waiters:
+            _, _, tokens, future = self._waiters[0]
+            if future.done():
+                # Cancelled while queued
+                heapq.heappop(self._waiters)
+                continue
+            concurrency = self.limits["concurrency"]
+            if concurrency and self.active >= concurrency:
+                return
+            delay = self._delay(tokens, now)
+            if delay > 0:
+                self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                return
+            heapq.heappop(self._waiters)
+            entry = [now, tokens]
+            self._window.append(entry)
+            self.active += 1
+            future.set_result(Ticket(entry))
+
+    def _release(self):
+        self.active -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_NORMAL, tokens: int = 0):
+        """
+        Wait until the request may start and hold a concurrency slot while the block runs.
+        :param priority: PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW.
+        :param tokens: Estimated cost counted against the tokens-per-minute limit.
+        :return: A Ticket to record the real token usage with.
+        """
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), tokens, future))
+        started = time.perf_counter()
+        self._dispatch()
+        try:
+            ticket = await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release()
+            else:
+                self._dispatch()
+            raise
+        record_timing(f"{self.name}.queue", time.perf_counter() - started)
+        try:
+            yield ticket
+        finally:
+            self._release()
+
+
+_providers = {}
+
+
+def get_provider(name: str) -> Provider:
+    """Return the shared scheduler of an upstream API ("gemini", "elevenlabs"...)."""
+    if name not in _providers:
+        _providers[name] = Provider(name)
+    return _providers[name]
+
+
+_flights = {}
+
+
+@contextmanager
+def flight(key):
+    """
+    Register the caller as the one doing the work for `key`; concurrent join(key) calls get its outcome.
+    Publish the result with the yielded future's set_result(). An exception raised in the block
+    is passed on to the waiters, and if the block is cancelled they are released to do the work themselves.
+    """
+    if key in _flights:
+        raise RuntimeError(f"{key!r} is already in flight; join() it instead")
+    future = asyncio.get_running_loop().create_future()
+    _flights[key] = future
+    try:
+        yield future
+    except Exception as e:
+        if not future.done():
+            future.set_exception(e)
+            # Marks the exception as retrieved when nobody was waiting
+            future.exception()
+        raise
+    finally:
+        if _flights.get(key) is future:
+            del _flights[key]
+        if not future.done():
+            future.cancel()
+
+
+async def join(key):
+    """
+    Wait for the work running for `key`, if any. If that work is cancelled, the waiter that
+    resumes first takes it over and the others join it, so it still runs only once.
+    :return: (True, its result), or (False, None) if nothing is running; the caller should then
+        start flight(key) before awaiting anything else.
+    """
+    while True:
+        future = _flights.get(key)
+        if future is None:
+            return False, None
+        try:
+            return True, await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise
+
+
+async def single_flight(key, factory):
+    """
+    Coalesce identical concurrent calls: only the first caller runs factory() and every
+    caller with the same key gets its result (or exception).
+    :param key: Hashable identity of the call.
+    :param factory: Coroutine function doing the actual work.
+    """
+    joined, result = await join(key)
+    if joined:
+        return result
+    with flight(key) as shared:
+        result = await factory()
+        shared.set_result(result)
+    return result
+
+
+@Client.on_message(filters.command("limits", prefix) & filters.me)
+async def provider_limits(_, message: Message):
+    """Show or change the per-provider request limits."""
+    args = message.command[1:]
+    if args:
+        name = args[0].lower()
+        values = args[1:]
+        if name not in DEFAULT_LIMITS or len(values) != len(LIMIT_NAMES) or not all(v.isdigit() for v in values):
+            return await message.edit_text(
+                f"<b>Usage:</b> <code>{prefix}limits [{'|'.join(DEFAULT_LIMITS)}] [rpm] [tpm] [concurrency]</code>"
+            )
+        settings.set(name, dict(zip(LIMIT_NAMES, map(int, values))))
+        get_provider(name)._dispatch()
+
+    lines = ["<b>Provider limits</b> (0 = unlimited)"]
+    for name in DEFAULT_LIMITS:
+        provider = get_provider(name)
+        limits = provider.limits
+        requests, tokens = provider.usage()
+        lines.append(
+            f"<b>{name}:</b> <code>{limits['rpm']}</code> rpm, <code>{limits['tpm']}</code> tpm, "
+            f"<code>{limits['concurrency']}</code> at once | last minute: <code>{requests}</code> requests, "
+            f"<code>{tokens}</code> tokens | <code>{provider.active}</code> running, <code>{provider.queued}</code> queued"
+        )
+    await message.edit_text("\n".join(lines))
+
+
+modules_help["limits"] = {
+    "limits": "Show the Gemini and ElevenLabs request limits and current usage.",
+    "limits [provider] [rpm] [tpm] [concurrency]": "Set the limits of a provider (ElevenLabs tokens are characters, 0 = unlimited).",
+}
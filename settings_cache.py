@@ -0,0 +1,69 @@
+from utils.db import db
+
+_MISSING = object()
+
+
+class Settings:
+    """
+    Read-through, write-through cache of one utils.db module namespace.
+    The namespace is loaded once; reads are then served from memory and
+    set()/remove() update the store and the cache together.
+    """
+
+    def __init__(self, module: str):
+        self.module = module
+        self.hits = 0
+        self.misses = 0
+        self._values = None
+        self._complete = False
+
+    def _load(self) -> dict:
+        if self._values is None:
+            self.misses += 1
+            get_collection = getattr(db, "get_collection", None)
+            self._values = dict(get_collection(self.module) or {}) if get_collection else {}
+            self._complete = get_collection is not None
+        return self._values
+
+    def get(self, variable: str, default=None):
+        values = self._load()
+        value = values.get(variable, _MISSING)
+        if value is _MISSING and not self._complete:
+            # Stores without get_collection() are filled one variable at a time
+            self.misses += 1
+            value = values[variable] = db.get(self.module, variable, _MISSING)
+        else:
+            self.hits += 1
+        return default if value is _MISSING else value
+
+    def set(self, variable: str, value):
+        db.set(self.module, variable, value)
+        self._load()[variable] = value
+
+    def remove(self, variable: str):
+        db.remove(self.module, variable)
+        self._load().pop(variable, None)
+
+    def invalidate(self):
+        """Drop the cached namespace so the next read reloads it from the store."""
+        self._values = None
+
+
+_settings = {}
+
+
+def get_settings(module: str) -> Settings:
+    """Return the shared settings cache for a utils.db module namespace."""
+    if module not in _settings:
+        _settings[module] = Settings(module)
+    return _settings[module]
+
+
+def settings_stats() -> dict:
+    """Hit/miss counters of every settings namespace in use."""
+    return {module: {"hits": s.hits, "misses": s.misses} for module, s in _settings.items()}
+
+
+def reset_settings_stats():
+    for s in _settings.values():
+        s.hits = s.misses = 0